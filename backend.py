@@ -1,25 +1,344 @@
 # backend.py
 # openeventdatabase
 
-from datetime import datetime
+import base64
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import contextvars
+from datetime import datetime, timezone
+import hashlib
+import io
 import json
+import logging
+import math
 import os
+import random
 import re
-import subprocess
+import select
+import threading
+import time
+import zoneinfo
 
 import falcon
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
 import geojson
 
-def db_connect():
-    return psycopg2.connect(
+import polyline
+
+
+log = logging.getLogger('oedb')
+
+
+# phase -> seconds spent in the current request, see MetricsMiddleware
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to phase, for the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = request_timings.get()
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+
+class Metrics:
+    """Request and slow query metrics of this process, in Prometheus text format."""
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, slow_query, explain_rate, keep=100):
+        self.slow_query = slow_query        # seconds
+        self.explain_rate = explain_rate    # part of slow queries explained
+        self.lock = threading.Lock()
+        self.requests = {}      # (route, method, status) -> [count, sum, bucket counts]
+        self.phases = {}        # (route, phase) -> seconds
+        self.slow_count = 0
+        self.slow = deque(maxlen=keep)
+
+    def observe(self, route, method, status, seconds, timings):
+        with self.lock:
+            r = self.requests.setdefault((route, method, status), [0, 0.0, [0] * len(self.buckets)])
+            r[0] += 1
+            r[1] += seconds
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    r[2][i] += 1
+            for phase, t in timings.items():
+                self.phases[(route, phase)] = self.phases.get((route, phase), 0) + t
+
+    def slow_query_sample(self, sql, seconds, plan=None):
+        # values are bound parameters, the statement text is already normalized
+        with self.lock:
+            self.slow_count += 1
+            self.slow.append(dict(sql=' '.join(sql.split()), seconds=seconds, plan=plan,
+                                  time=datetime.now(timezone.utc)))
+
+    def explain(self):
+        return self.explain_rate > 0 and random.random() < self.explain_rate
+
+    def render(self, values):
+        """Return the metrics text, with other values {(name, type, help): value}."""
+        def labels(**kw):
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in sorted(kw.items()))
+        lines = ['# HELP oedb_request_seconds Request duration (this worker)',
+                 '# TYPE oedb_request_seconds histogram']
+        with self.lock:
+            for (route, method, status), (count, total, buckets) in sorted(self.requests.items()):
+                l = labels(route=route, method=method, status=status)
+                for le, n in zip(self.buckets, buckets):
+                    lines.append('oedb_request_seconds_bucket{%s,le="%s"} %d' % (l, le, n))
+                lines.append('oedb_request_seconds_bucket{%s,le="+Inf"} %d' % (l, count))
+                lines.append('oedb_request_seconds_sum{%s} %f' % (l, total))
+                lines.append('oedb_request_seconds_count{%s} %d' % (l, count))
+            lines += ['# HELP oedb_request_phase_seconds_total Time spent by requests in db connect, query, convert and serialize (this worker)',
+                      '# TYPE oedb_request_phase_seconds_total counter']
+            for (route, phase), total in sorted(self.phases.items()):
+                lines.append('oedb_request_phase_seconds_total{%s} %f' % (labels(route=route, phase=phase), total))
+            lines += ['# HELP oedb_slow_queries_total Queries slower than SLOW_QUERY_MS (this worker)',
+                      '# TYPE oedb_slow_queries_total counter',
+                      'oedb_slow_queries_total %d' % self.slow_count]
+        for (name, type, help), value in sorted(values.items()):
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, type), '%s %s' % (name, value)]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(float(os.getenv("SLOW_QUERY_MS", 500)) / 1000, float(os.getenv("SLOW_QUERY_EXPLAIN", 0)))
+
+
+def db_params():
+    return dict(
         dbname=os.getenv("DB_NAME", "oedb"),
         host=os.getenv("DB_HOST", ""),
         password=os.getenv("POSTGRES_PASSWORD", None),
         user=os.getenv("DB_USER", ""))
 
 
+def db_timezone(db):
+    # time zone of the session, the one of timestamp (without time zone) values
+    try:
+        return zoneinfo.ZoneInfo(db.get_parameter_status('TimeZone'))
+    except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+        return timezone.utc
+
+
+def db_connect():
+    # dedicated connection, outside of the pool
+    return psycopg2.connect(**db_params())
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # connection with some bookkeeping used by ConnectionPool
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uses = 0
+        self.last_used = time.monotonic()
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """Process-wide pool of database connections shared by all resources.
+
+    The pool is created lazily in the process serving requests, so that
+    uwsgi/gunicorn workers forked from a master never share sockets.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, max_uses=1000, timeout=10, check_idle=30):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_uses = max_uses        # recycle connections after N borrows
+        self.timeout = timeout          # max wait (seconds) for a free connection
+        self.check_idle = check_idle    # ping connections idle for more than N seconds
+        self.lock = threading.Lock()
+        self.pid = None
+        self.idle = []
+        self.inherited = []
+        self.slots = None
+        self.counters = dict(borrowed=0, waits=0, timeouts=0, created=0, recycled=0, broken=0, in_use=0, max_in_use=0)
+
+    def _connect(self):
+        self.counters['created'] += 1
+        return psycopg2.connect(connection_factory=PooledConnection, **db_params())
+
+    def _check_pid(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # connections opened by a parent process must not be closed here,
+            # it would terminate the parent sessions
+            self.inherited.extend(self.idle)
+            self.idle = [self._connect() for i in range(self.minconn)]
+            self.slots = threading.BoundedSemaphore(self.maxconn)
+            self.counters.update(in_use=0, max_in_use=0)
+            self.pid = os.getpid()
+
+    def _healthy(self, db):
+        if db.closed or db.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - db.last_used > self.check_idle:
+            try:
+                cur = db.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                db.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, db):
+        try:
+            db.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        with timed('connect'):
+            return self._getconn()
+
+    def _getconn(self):
+        self._check_pid()
+        if not self.slots.acquire(blocking=False):
+            self.counters['waits'] += 1
+            if not self.slots.acquire(timeout=self.timeout):
+                self.counters['timeouts'] += 1
+                raise falcon.HTTPServiceUnavailable(description='database connection pool exhausted')
+        try:
+            while True:
+                with self.lock:
+                    db = self.idle.pop() if self.idle else None
+                if db is None:
+                    db = self._connect()
+                    break
+                if self._healthy(db):
+                    break
+                self.counters['broken'] += 1
+                self._discard(db)
+        except Exception:
+            self.slots.release()
+            raise
+        db.uses += 1
+        with self.lock:
+            self.counters['borrowed'] += 1
+            self.counters['in_use'] += 1
+            self.counters['max_in_use'] = max(self.counters['max_in_use'], self.counters['in_use'])
+        return db
+
+    def putconn(self, db):
+        if not db.closed and db.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # uncommitted work is never handed over to the next borrower
+            try:
+                db.rollback()
+            except psycopg2.Error:
+                self._discard(db)
+        if not db.closed and db.uses >= self.max_uses:
+            self.counters['recycled'] += 1
+            self._discard(db)
+        db.last_used = time.monotonic()
+        with self.lock:
+            if not db.closed:
+                self.idle.append(db)
+            self.counters['in_use'] -= 1
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        db = self.getconn()
+        try:
+            yield db
+        finally:
+            self.putconn(db)
+
+    def stats(self):
+        return dict(self.counters, idle=len(self.idle), min_size=self.minconn, max_size=self.maxconn)
+
+
+db_pool = ConnectionPool(
+    minconn=int(os.getenv("DB_POOL_MIN", 1)),
+    maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+    max_uses=int(os.getenv("DB_POOL_MAX_USES", 1000)),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)))
+
+
+class Query:
+    """Parameters of an SQL statement assembled from fragments.
+
+    Fragments reference parameters with named placeholders returned by
+    param(), so the statement text only depends on which filters are used
+    and never on their values: a small set of stable statement shapes which
+    can be prepared once per connection.
+    """
+
+    def __init__(self):
+        self.params = {}
+
+    def param(self, value, cast=None):
+        name = 'p%d' % len(self.params)
+        self.params[name] = value
+        if cast is None:
+            return '%%(%s)s' % name
+        return '%%(%s)s::%s' % (name, cast)
+
+
+# sql -> (statement name, PREPARE text, ordered parameter names)
+prepared_statements = {}
+
+
+def prepare_statement(sql):
+    if sql not in prepared_statements:
+        names = []
+        def placeholder(m):
+            if m.group(1) not in names:
+                names.append(m.group(1))
+            return '$%d' % (names.index(m.group(1)) + 1)
+        text = re.sub(r'%\((\w+)\)s', placeholder, sql).replace('%%', '%')
+        name = 'oedb_' + hashlib.md5(sql.encode('utf-8')).hexdigest()[:16]
+        prepared_statements[sql] = (name, 'PREPARE %s AS %s' % (name, text), names)
+    return prepared_statements[sql]
+
+
+def execute_prepared(cur, sql, params):
+    """Execute sql (named placeholders) as a prepared statement on pooled connections.
+
+    Statements slower than metrics.slow_query are recorded, some of them
+    with their EXPLAIN (ANALYZE, BUFFERS) plan.
+    """
+    start = time.perf_counter()
+    with timed('query'):
+        statement, args = sql, params
+        prepared = getattr(cur.connection, 'prepared', None)
+        if prepared is not None:
+            name, prepare, names = prepare_statement(sql)
+            if name not in prepared:
+                # prepared statements live as long as the session, even if the
+                # current transaction is rolled back
+                cur.execute(prepare)
+                prepared.add(name)
+            if names:
+                statement = 'EXECUTE %s (%s)' % (name, ','.join('%%(%s)s' % n for n in names))
+            else:
+                statement, args = 'EXECUTE %s' % name, None
+        cur.execute(statement, args)
+    seconds = time.perf_counter() - start
+    if seconds >= metrics.slow_query:
+        plan = None
+        # only read statements go through here, they can be run again
+        if metrics.explain():
+            explain = cur.connection.cursor()
+            explain.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, args)
+            plan = '\n'.join(r[0] for r in explain.fetchall())
+            explain.close()
+        metrics.slow_query_sample(sql, seconds, plan)
+
+
 class EventEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime):
@@ -34,6 +353,100 @@ def dumps(data):
     return json.dumps(data, cls=EventEncoder, sort_keys=True, ensure_ascii=False)
 
 
+class LRUCache:
+    """Bounded mapping, the least recently used entries are evicted first."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = dict(hits=0, misses=0, evictions=0)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                self.counters['misses'] += 1
+                return None
+            self.data.move_to_end(key)
+            self.counters['hits'] += 1
+            return self.data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def stats(self):
+        lookups = self.counters['hits'] + self.counters['misses']
+        return dict(self.counters, size=len(self.data), max_size=self.maxsize,
+                    hit_rate=round(self.counters['hits'] / lookups, 4) if lookups else None)
+
+
+def geometry_key(geometry):
+    """Canonical serialization of a GeoJSON geometry, None if it can't be built.
+
+    Coordinates are compared as floats, so that equal geometries get the
+    same key whatever their original formatting.
+    """
+    def floats(c):
+        if isinstance(c, list):
+            return [floats(x) for x in c]
+        return float(c)
+    def canonical(g):
+        if 'geometries' in g:
+            return dict(type=g['type'], geometries=[canonical(x) for x in g['geometries']])
+        return dict(type=g['type'], coordinates=floats(g['coordinates']))
+    try:
+        return json.dumps(canonical(geometry), sort_keys=True)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class GeometryCache(LRUCache):
+    """Geometry key to geo.hash mapping, for geometries known to be in geo.
+
+    Only hashes of valid geometries, inserted or already present in geo,
+    are cached. Rows are never deleted from geo, evicting an entry only
+    means the next lookup goes to the database again.
+    """
+
+    def __init__(self, maxsize, warmup=0):
+        super().__init__(maxsize)
+        self.warmup = warmup
+        self.warmed = None
+
+    def warm_up(self, cur):
+        # once per process, load the geometries of the most recently updated events
+        if self.warmed == os.getpid():
+            return
+        self.warmed = os.getpid()
+        if self.warmup <= 0:
+            return
+        # geometries not surviving the geojson round-trip are skipped, their
+        # key would not match the stored geometry
+        cur.execute("""SELECT geojson, hash FROM
+                            (SELECT st_asgeojson(geom, 15) as geojson, hash FROM geo
+                                WHERE hash IN (SELECT events_geo FROM events ORDER BY lastupdate DESC LIMIT %s)) as g
+                        WHERE md5(st_astext(st_setsrid(st_geomfromgeojson(geojson),4326))) = hash;""",
+                    (self.warmup,))
+        for text, h in cur.fetchall():
+            self.put(geometry_key(json.loads(text)), h)
+
+
+geo_cache = GeometryCache(
+    maxsize=int(os.getenv("GEO_CACHE_SIZE", 10000)),
+    warmup=int(os.getenv("GEO_CACHE_WARMUP", 1000)))
+
+
 class HeaderMiddleware:
 
     def process_response(self, req, resp, resource, params):
@@ -43,32 +456,180 @@ class HeaderMiddleware:
         resp.set_header('Access-Control-Allow-Headers', 'Content-Type')
         resp.set_header('Access-Control-Allow-Methods','GET, POST, PUT, DELETE, OPTIONS')
 
+    async def process_response_async(self, req, resp, resource, params):
+        self.process_response(req, resp, resource, params)
+
+
+def system_uptime():
+    """Host uptime formatted like `uptime -p`, without forking a process."""
+    with open('/proc/uptime') as f:
+        minutes = int(float(f.read().split()[0])) // 60
+    parts = []
+    for unit, length in (('year', 525600), ('week', 10080), ('day', 1440), ('hour', 60), ('minute', 1)):
+        n, minutes = divmod(minutes, length)
+        if n:
+            parts.append('%d %s%s' % (n, unit, 's' if n > 1 else ''))
+    return 'up ' + (', '.join(parts) or '0 minutes')
+
+
+def refresh_summary(db, view, max_age):
+    """Refresh the materialized view if its 'refreshed' column is older than max_age seconds.
+
+    Only one worker refreshes a given view at a time, the others keep
+    using the current content.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT extract(epoch FROM now() - max(refreshed)) FROM %s;" % view)
+    age = cur.fetchone()[0]
+    if age is None or age > max_age:
+        cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s));", (view,))
+        if cur.fetchone()[0]:
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY %s;" % view)
+        db.commit()
+    cur.close()
+
+
+class CachedValue:
+    """Value computed by a function and kept for ttl seconds.
+
+    While a thread recomputes an expired value, the others get the
+    previous one instead of waiting.
+    """
+
+    def __init__(self, compute, ttl):
+        self.compute = compute
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.value = None
+        self.expires = 0
+
+    def get(self):
+        if time.monotonic() >= self.expires or self.value is None:
+            if self.lock.acquire(blocking=self.value is None):
+                try:
+                    if time.monotonic() >= self.expires or self.value is None:
+                        self.value = self.compute()
+                        self.expires = time.monotonic() + self.ttl
+                finally:
+                    self.lock.release()
+        return self.value
+
+
+class CacheMiddleware:
+    # let HTTP caches (CDN) keep successful reads for a while
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        # resources may set their own policy
+        if (req.method == 'GET' and resp.status_code in (200, 304)
+                and resp.get_header('Cache-Control') is None):
+            resp.cache_control = ['public', 'max-age=%d' % self.max_age]
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class MetricsMiddleware:
+    """Record the duration of requests, per route, and of their phases (see timed)."""
+
+    def process_request(self, req, resp):
+        req.context.timings = {}
+        req.context.timings_token = request_timings.set(req.context.timings)
+        req.context.start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if 'start' not in req.context:
+            return
+        # streamed bodies are sent after this, and not accounted for
+        metrics.observe(req.uri_template or 'unknown', req.method, resp.status_code,
+                        time.perf_counter() - req.context.start, req.context.timings)
+        request_timings.reset(req.context.timings_token)
+
+
+class MetricsResource:
+    """Prometheus metrics (/metrics) and recent slow queries (/metrics/slow) of this worker."""
+
+    def on_get(self, req, resp):
+        pool = db_pool.stats()
+        cache = geo_cache.stats()
+        values = {
+            ('oedb_pool_connections_in_use', 'gauge', 'Pooled connections in use'): pool['in_use'],
+            ('oedb_pool_connections_idle', 'gauge', 'Idle pooled connections'): pool['idle'],
+            ('oedb_pool_waits_total', 'counter', 'Connection requests that had to wait'): pool['waits'],
+            ('oedb_pool_timeouts_total', 'counter', 'Connection requests that timed out'): pool['timeouts'],
+            ('oedb_geo_cache_hits_total', 'counter', 'Geometry cache hits'): cache['hits'],
+            ('oedb_geo_cache_misses_total', 'counter', 'Geometry cache misses'): cache['misses'],
+        }
+        resp.cache_control = ['no-cache']
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.text = metrics.render(values)
+        resp.status = falcon.HTTP_200
+
+    def on_get_slow(self, req, resp):
+        resp.cache_control = ['no-cache']
+        with metrics.lock:
+            resp.text = dumps(list(metrics.slow))
+        resp.status = falcon.HTTP_200
+
 
 class StatsResource(object):
+    # estimated row count, way faster then count(*). The partitioned events
+    # table has no statistics of its own, the ones of its partitions are summed
+    count_sql = """SELECT coalesce(sum(greatest(reltuples, 0)), 0)::bigint FROM pg_class
+                    WHERE oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'events'::regclass);"""
+    # global info
+    info_sql = "SELECT max(lastupdate) as last_updated, current_timestamp-pg_postmaster_start_time() from events;"
+    # (what, last, count, sources)
+    recent_sql = "SELECT row_to_json(stat) from (SELECT what, last, count, source from events_stats order by last desc) as stat;"
+
+    def __init__(self):
+        self.cache = CachedValue(self.compute, float(os.getenv("STATS_CACHE_TTL", 60)))
+
+    def compute(self):
+        with db_pool.connection() as db:
+            # summary about last 10000 events, from events_stats materialized view
+            refresh_summary(db, 'events_stats', float(os.getenv("STATS_MAX_AGE", 300)))
+            cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute(self.count_sql)
+            count = cur.fetchone()[0]
+            cur.execute(self.info_sql)
+            pg_stats = cur.fetchone()
+            last = pg_stats[0]
+            pg_uptime = pg_stats[1]
+            cur.execute(self.recent_sql)
+            recent = cur.fetchall()
+            cur.close()
+        return dict(events_count=count, last_updated=last, db_uptime=pg_uptime, recent=recent)
+
     def on_get(self, req, resp):
-        db = db_connect()
-        cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # estimated row count, way faster then count(*)
-        cur.execute("SELECT reltuples::bigint FROM pg_class r WHERE relname = 'events';")
-        count = cur.fetchone()[0]
-        # global info
-        cur.execute("SELECT max(lastupdate) as last_updated, current_timestamp-pg_postmaster_start_time() from events;")
-        pg_stats = cur.fetchone()
-        last = pg_stats[0]
-        pg_uptime = pg_stats[1]
-        uptime = subprocess.check_output(["uptime","-p"]).decode('utf-8')[0:-1]
-        # summary about last 10000 events (what, last, count, sources)
-        cur.execute("SELECT row_to_json(stat) from (SELECT events_what as what, left(max(upper(events_when))::text,19) as last, count(*) as count, array_agg(distinct(regexp_replace(regexp_replace(events_tags ->> 'source','^(http://|https://)',''),'/.*',''))) as source from (select * from events order by lastupdate desc limit 10000) as last group by 1 order by 2 desc) as stat;")
-        recent = cur.fetchall()
-        cur.close()
-        db.close()
-        resp.text = dumps(dict(events_count=count, last_updated=last, uptime=uptime, db_uptime=pg_uptime, recent=recent))
+        resp.text = dumps(dict(self.cache.get(), uptime=system_uptime(), pool=db_pool.stats(), geo_cache=geo_cache.stats()))
         resp.status = falcon.HTTP_200
 
 
+# searches with a larger limit are streamed
+STREAM_LIMIT = int(os.getenv("STREAM_LIMIT", 1000))
+# maximum number of combinations of alternative values (tags=k=a|b,k2=c|d is 4)
+TAGS_ALTERNATIVES = int(os.getenv("TAGS_ALTERNATIVES", 100))
+# default GeoJSON renderer: 'python' or 'db'
+RENDER = os.getenv("RENDER", "python")
+# (tolerance in degrees, geo column) of the precomputed simplified geometries
+SIMPLIFY_LEVELS = ((0.0001, 'geom_s1'), (0.001, 'geom_s2'), (0.01, 'geom_s3'))
+# INSERT INTO geo columns and values computing them, geo_simplify is defined in setup.sql
+GEO_COLUMNS = "geom, hash, geom_center, " + ", ".join(c for t, c in SIMPLIFY_LEVELS)
+GEO_SIMPLIFIED = ", ".join("geo_simplify(geom, %s) as %s" % level for level in SIMPLIFY_LEVELS)
+
+
+def simplified_geom(tolerance):
+    """Return the geometry column of the precomputed level nearest to tolerance (log scale)."""
+    t, column = min(SIMPLIFY_LEVELS, key=lambda level: abs(math.log(level[0] / tolerance)))
+    # levels are not stored when they don't remove any point
+    return "coalesce(%s, geom)" % column
+
+
 class BaseEvent:
 
-    def row_to_feature(self, row, geom_only = False):
+    def row_to_feature(self, row, geom_only = False, fields = None):
         # only return geometry and event id
         if geom_only:
           return {
@@ -89,43 +650,232 @@ class BaseEvent:
             del properties['secret']
         if "distance" in row:
             properties['distance'] = row['distance']
+        if fields is not None:
+            # projection, the id is always kept
+            properties = dict((k, v) for k, v in properties.items() if k in fields or k == 'id')
         return {
             "type": "Feature",
             "geometry": json.loads(row['geometry']),
             "properties": properties
         }
 
-    def rows_to_collection(self, rows, geom_only = False):
+    def rows_to_collection(self, rows, geom_only = False, fields = None):
         return {
             "type": "FeatureCollection",
-            "features": [self.row_to_feature(r, geom_only) for r in rows],
+            "features": [self.row_to_feature(r, geom_only, fields) for r in rows],
             "count": len(rows)
         }
 
+    def feature_query(self, sql, geom_only = False, fields = None):
+        """Wrap sql so that Postgres returns each row as a GeoJSON Feature (text).
+
+        This is the SQL counterpart of row_to_feature: every column besides
+        events_id, events_tags and geometry (createdate, lastupdate, lon, lat
+        and distance when present) is copied to the properties. The sort key
+        of the row (see page_key) is returned as a second column, its id and
+        lastupdate (see validators) as third and fourth ones. With fields,
+        properties are restricted to the %(fields)s parameter.
+        """
+        if geom_only:
+            properties = "json_build_object('id', r.events_id)"
+        else:
+            properties = """(r.events_tags - 'secret')
+                            || (to_jsonb(r) - 'events_id' - 'events_tags' - 'geometry')
+                            || jsonb_build_object('id', r.events_id)"""
+            if fields is not None:
+                properties = """(SELECT jsonb_object_agg(key, value) FROM jsonb_each({properties})
+                                    WHERE key = ANY(%(fields)s::text[]) OR key = 'id')""".format(properties=properties)
+        return """SELECT json_build_object('type', 'Feature', 'geometry', r.geometry::json,
+                            'properties', {properties})::text AS feature,
+                        json_build_array(to_jsonb(r)->'distance', r.createdate, r.events_id) AS key,
+                        r.events_id::text AS id, r.lastupdate
+                    FROM ({sql}) AS r""".format(properties=properties, sql=sql)
+
+    def collection_query(self, sql, geom_only = False, fields = None):
+        """Wrap sql so that Postgres returns the whole FeatureCollection (text).
+
+        The number of features and the sort key of the last one are returned
+        as second and third columns, the ids and lastupdates of the features
+        as fourth and fifth ones.
+        """
+        # features are aggregated in the order of the (sorted) subquery
+        return """SELECT json_build_object('type', 'FeatureCollection',
+                            'features', coalesce(json_agg(f.feature::json), '[]'),
+                            'count', count(*))::text,
+                        count(*), (array_agg(f.key))[count(*)::integer],
+                        array_agg(f.id), array_agg(f.lastupdate)
+                    FROM ({sql}) AS f""".format(sql=self.feature_query(sql, geom_only, fields))
+
+    def page_key(self, row):
+        # sort key of a search result: [distance, createdate, id]
+        return [row.get('distance'), row['createdate'], row['events_id']]
+
+    def encode_cursor(self, key):
+        return base64.urlsafe_b64encode(dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Return the (distance, createdate, id) sort key of a cursor."""
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            distance, createdate, id = key
+        except (ValueError, TypeError):
+            raise falcon.HTTPBadRequest(description='invalid cursor')
+        return distance, createdate, id
+
+    def next_cursor(self, count, key, limit):
+        # a full page may be followed by another one, starting after key
+        if limit is None or count < limit or key is None:
+            return None
+        return self.encode_cursor(key)
+
+    def page_limit(self, req):
+        return req.get_param_as_int('limit', min_value=0, default=200)
+
+    def page_collection(self, rows, geom_only=False, limit=None, fields=None):
+        """FeatureCollection of rows, with the cursor of the next page."""
+        collection = self.rows_to_collection(rows, geom_only, fields)
+        cursor = self.next_cursor(len(rows), self.page_key(rows[-1]) if rows else None, limit)
+        if cursor is not None:
+            collection['next'] = cursor
+        return collection
+
+    def page_collection_text(self, row, limit=None):
+        """FeatureCollection (text) from a collection_query row, with the cursor of the next page."""
+        text, count, key = row[:3]
+        cursor = self.next_cursor(count, key, limit)
+        if cursor is not None:
+            text = text[:-1] + ', "next": %s}' % dumps(cursor)
+        return text
+
+    def collection_end(self, count, key, limit=None):
+        # end of a streamed FeatureCollection
+        cursor = self.next_cursor(count, key, limit)
+        if cursor is None:
+            return ('], "count": %d}' % count).encode('utf-8')
+        return ('], "count": %d, "next": %s}' % (count, dumps(cursor))).encode('utf-8')
+
+    def check_feature(self, j):
+        """Check a GeoJSON Feature payload, missing members are set to None.
+
+        Return the error messages, an empty string for a complete feature.
+        """
+        errors = ''
+        if "properties" not in j:
+            errors = errors + "missing 'properties' elements\n"
+            j['properties'] = dict()
+        if "geometry" not in j:
+            errors = errors + "missing 'geometry' elements\n"
+            j['geometry'] = None
+        if "when" not in j['properties'] and ("start" not in j['properties'] or "stop" not in j['properties']) :
+            errors = errors + "missing 'when' or 'start/stop' in properties\n"
+            j['properties']['when'] = None
+        if "type" not in j['properties']:
+            errors = errors + "missing 'type' of event in properties\n"
+            j['properties']['type'] = None
+        if "what" not in j['properties']:
+            errors = errors + "missing 'what' in properties\n"
+            j['properties']['what'] = None
+        if "type" in j and j['type'] != 'Feature':
+            errors = errors + 'geojson must be "type":"Feature" only\n'
+        return errors
+
+    def feature_when(self, j):
+        """Return (start, stop, bounds) of the events_when range of a checked Feature."""
+        if "start" not in j['properties']:
+            event_start = j['properties']['when']
+        else:
+            event_start = j['properties']['start']
+        if "stop" not in j['properties']:
+            event_stop = j['properties']['when']
+        else:
+            event_stop = j['properties']['stop']
+        if not event_stop:
+            event_stop = event_start
+        if event_start == event_stop:
+            bounds = '[]'
+        else:
+            bounds = '[)'
+        return event_start, event_stop, bounds
+
+    def param_list(self, req, name):
+        """Return the values of a comma separated (or repeated) parameter, None when missing.
+
+        Falcon does not split comma separated values (auto_parse_qs_csv),
+        which would also split bbox and near.
+        """
+        values = req.get_param_as_list(name)
+        if values is None:
+            return None
+        return [v for value in values for v in value.split(',') if v != '']
+
+    def output_fields(self, req):
+        # properties to return (fields=label,start,...), None for all of them
+        return self.param_list(req, 'fields')
+
+    def render_in_db(self, req):
+        # let Postgres build the GeoJSON output (render=db) instead of python
+        return req.get_param('render', default=RENDER) == 'db'
+
 
 class EventResource(BaseEvent):
-    def maybe_insert_geometry(self, geometry, cur):
-        # insert into geo table if not existing
-        cur.execute("""INSERT INTO geo
-                            SELECT geom, md5(st_astext(geom)) as hash, st_centroid(geom) as geom_center FROM
+    # SQL statements, shared with the ASGI variant (backend_asgi.py)
+    geo_insert_sql = """INSERT INTO geo (""" + GEO_COLUMNS + """)
+                            SELECT geom, md5(st_astext(geom)) as hash, st_centroid(geom) as geom_center, """ + GEO_SIMPLIFIED + """ FROM
                                     (SELECT st_setsrid(st_geomfromgeojson( %s ),4326) as geom) as g
                                 WHERE ST_IsValid(geom)
-                        ON CONFLICT DO NOTHING RETURNING hash;""",
-                    (geometry,))
+                        ON CONFLICT DO NOTHING RETURNING hash;"""
+    geo_check_sql = """SELECT md5(st_astext(geom)),
+                            ST_IsValid(geom),
+                            ST_IsValidReason(geom) from (SELECT st_setsrid(st_geomfromgeojson( %s ),4326) as geom) as g ;"""
+    event_sql = "SELECT events_id, events_tags, createdate, lastupdate, st_asgeojson(geom) as geometry, st_x(geom_center) as lon, st_y(geom_center) as lat FROM events JOIN geo ON (hash=events_geo) WHERE events_id=%(id)s::uuid"
+    # events_end (upper bound of events_when) is the partition key of events
+    insert_sql = """INSERT INTO events ( events_type, events_what, events_when, events_end, events_tags, events_geo)
+                        SELECT t, w, r, coalesce(upper(r), 'infinity'), g, h FROM
+                            (SELECT %s::text as t, %s::text as w, tstzrange(%s,%s,%s) as r, %s::jsonb as g, %s::text as h) as v
+                        ON CONFLICT DO NOTHING RETURNING events_id;"""
+    # coalesce are used to PATCH the data (new value may be NULL to keep the old one)
+    update_sql = """UPDATE events SET ( events_type, events_what, events_when, events_end, events_tags, events_geo) =
+                        (SELECT t, w, r, coalesce(upper(r), 'infinity'), g, h FROM
+                            (SELECT coalesce(%s, events_type) as t, coalesce(%s, events_what) as w, tstzrange(coalesce(%s, lower(events_when)),coalesce(%s, upper(events_when)),%s) as r, events_tags::jsonb || (%s::jsonb -'secret') as g, coalesce(%s, events_geo) as h) as v)
+                              WHERE events_id = %s {secret} RETURNING events_id;"""
+    secret_sql = " AND (events_tags->>'secret' = %s OR events_tags->>'secret' IS NULL) "
+    no_secret_sql = " AND events_tags->>'secret' IS NULL "
+    duplicate_sql = """SELECT events_id FROM events WHERE events_what=%s
+                          AND events_when=tstzrange(%s,%s,%s) AND events_geo=%s;"""
+    patch_duplicate_sql = """WITH s AS (SELECT * FROM events WHERE events_id = %s) SELECT e.events_id FROM events e, s WHERE e.events_what=coalesce(%s, s.events_what)
+                          AND e.events_when=tstzrange(coalesce(%s, lower(s.events_when)),coalesce(%s,upper(s.events_when)),%s) AND e.events_geo=coalesce(%s, s.events_geo);"""
+    archive_sql = """INSERT INTO events_deleted SELECT events_id, createdate, lastupdate, events_type, events_what, events_when, events_geo, events_tags FROM events WHERE events_id = %s """
+    delete_sql = """DELETE FROM events WHERE events_id = %s AND events_tags->>'secret' IS NULL;"""
+    delete_secret_sql = """DELETE FROM events WHERE events_id = %s AND (events_tags->>'secret' = %s OR events_tags->>'secret' IS NULL)"""
+
+    def maybe_insert_geometry(self, geometry, cur):
+        # known geometry, no need to query the database
+        geo_cache.warm_up(cur)
+        key = geometry_key(geometry)
+        h = geo_cache.get(key) if key is not None else None
+        if h is not None:
+            return (h,)
+        geometry = dumps(geometry)
+        # insert into geo table if not existing
+        cur.execute(self.geo_insert_sql, (geometry,))
         # get its id (md5 hash)
         h = cur.fetchone()
         if h is None:
-            cur.execute("""SELECT md5(st_astext(geom)),
-                            ST_IsValid(geom),
-                            ST_IsValidReason(geom) from (SELECT st_setsrid(st_geomfromgeojson( %s ),4326) as geom) as g ;""", (geometry,))
+            cur.execute(self.geo_check_sql, (geometry,))
             h = cur.fetchone()
         return h
 
 
-    def relative_time(self, when, cur):
+    def cache_geometry(self, geometry, h):
+        key = geometry_key(geometry)
+        if key is not None:
+            geo_cache.put(key, h)
+
+
+    def relative_time(self, when, q):
         when = when.upper().replace(' ','+')
-        event_start = cur.mogrify("%s",(when,)).decode("utf-8")
-        event_stop  = cur.mogrify("%s",(when,)).decode("utf-8")
+        event_start = None
+        event_stop  = None
 
         if when == 'NOW':
             event_start = "now()"
@@ -145,147 +895,468 @@ class EventResource(BaseEvent):
         m = re.match('(LAST|NEXT) *([0-9]*) *(YEAR|MONTH|WEEK|MINUTE|HOUR|DAY)S?',when)
         if m is not None:
             if m.group(1) == 'LAST':
-                event_start = "now() - INTERVAL '%s %s'" % m.group(2,3)
+                event_start = "now() - %s" % q.param('%s %s' % m.group(2,3), 'interval')
                 event_stop  = "now()"
             else:
                 event_start = "now()"
-                event_stop  = "now() + INTERVAL '%s %s'" % m.group(2,3)
+                event_stop  = "now() + %s" % q.param('%s %s' % m.group(2,3), 'interval')
+        if event_start is None:
+            event_start = event_stop = q.param(when, 'timestamptz')
 
         return event_start, event_stop
 
 
-    def on_get(self, req, resp, id=None, geom=None):
-        db = db_connect()
-        cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        if id is None:
-            event_sort = "createdate DESC"
-            # get query search parameters
-            if geom is not None:
-                # convert our geojson geom to WKT
-                geoj = json.dumps(geom)
-                # buffer around geom ?
-                if 'buffer' in req.params:
-                  buffer = float(req.params['buffer'])
-                elif geom['type'] == 'Linestring':
-                  buffer = 1000 # 1km buffer by default around Linestrings
-                else:
-                  buffer = 0
-                if buffer == 0:
-                  event_bbox = cur.mogrify(" AND ST_Intersects(geom, ST_SetSRID(ST_GeomFromGeoJSON(%s),4326)) ",(geoj,)).decode("utf-8")
-                else:
-                  event_bbox = cur.mogrify(" AND ST_Intersects(geom, ST_Buffer(ST_SetSRID(ST_GeomFromGeoJSON(%s),4326)::geography, %s)::geometry) ",(geoj, buffer)).decode("utf-8")
-                event_dist = cur.mogrify("ST_Length(ST_ShortestLine(geom, ST_SetSRID(ST_GeomFromGeoJSON(%s),4326))::geography)::integer as distance, ",(geoj,)).decode("utf-8")
-                event_sort = cur.mogrify("ST_Length(ST_ShortestLine(geom, ST_SetSRID(ST_GeomFromGeoJSON(%s),4326))::geography)::integer, ", (geoj,)).decode("utf-8")+event_sort
-            elif 'bbox' in req.params:
-                # limit search with bbox (E,S,W,N)
-                event_bbox = cur.mogrify(" AND geom && ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s),ST_Point(%s,%s)),4326) ", tuple(req.params['bbox'].split(','))).decode("utf-8")
-                event_dist = ""
-            elif 'near' in req.params:
-                # Limit search with location+distance
-                # (long, lat, distance in meters)
-                near = req.params['near'].split(',')
-                if len(near) < 3:
-                    dist = 1
-                else:
-                    dist = near[2]
-                event_bbox = cur.mogrify(" AND ST_Intersects(geom, ST_Buffer(st_setsrid(st_makepoint(%s,%s),4326)::geography,%s)::geometry) ", (near[0], near[1], dist)).decode("utf-8")
-                event_dist = cur.mogrify("ST_Length(ST_ShortestLine(geom, st_setsrid(st_makepoint(%s,%s),4326))::geography)::integer as distance,", (near[0], near[1])).decode("utf-8")
-                event_sort = cur.mogrify("ST_Length(ST_ShortestLine(geom, st_setsrid(st_makepoint(%s,%s),4326))::geography)::integer, ", (near[0], near[1])).decode("utf-8")+event_sort
-            elif 'polyline' in req.params:
-                # use encoded polyline as search geometry
-                if 'buffer' in req.params:
-                    buffer = float(req.params['buffer'])
-                else:
-                    buffer = 1000
-                if 'polyline_precision' in req.params:
-                    precision = int(req.params['polyline_precision'])
-                else:
-                    precision = 5
-                # ST_Scale is a workaround to postgis bug not taking precision into account in ST_LineFromEncodedPolyline
-                event_bbox = cur.mogrify(" AND ST_Intersects(geom, ST_Buffer(ST_Scale(ST_LineFromEncodedPolyline(%s),1/10^(%s-5),1/10^(%s-5))::geography, %s)::geometry) ",(req.params['polyline'], precision, precision, buffer)).decode("utf-8")
-                event_dist = cur.mogrify("ST_Length(ST_ShortestLine(geom, ST_Scale(ST_LineFromEncodedPolyline(%s),1/10^(%s-5),1/10^(%s-5)))::geography)::integer as distance, ",(req.params['polyline'], precision, precision)).decode("utf-8")
-            elif 'where:osm' in req.params:
-                event_bbox = cur.mogrify(" AND events_tags ? 'where:osm' AND events_tags->>'where:osm'=%s ", (req.params['where:osm'],)).decode("utf-8")
-                event_dist = ""
-            elif 'where:wikidata' in req.params:
-                event_bbox = cur.mogrify(" AND events_tags ? 'where:wikidata' AND events_tags->>'where:wikidata'=%s ", (req.params['where:wikidata'],)).decode("utf-8")
-                event_dist = ""
+    def search_filters(self, req, q, geom=None):
+        """Return the SQL fragments matching the search parameters of req.
+
+        event_sort_dist is the distance results are sorted by, if any.
+        Distances are filtered with ST_DWithin on geography, which uses the
+        geo_geog index as a bounding box prefilter, and computed once, in
+        the distance column.
+        """
+        # events_id makes the order total, for cursors
+        event_sort = "createdate DESC, events_id DESC"
+        event_sort_dist = ""
+        # get query search parameters
+        if geom is not None:
+            # convert our geojson geom to WKT
+            geoj = "ST_SetSRID(ST_GeomFromGeoJSON(%s),4326)" % q.param(json.dumps(geom), 'text')
+            # buffer around geom ?
+            if 'buffer' in req.params:
+              buffer = float(req.params['buffer'])
+            elif geom['type'] == 'LineString':
+              buffer = 1000 # 1km buffer by default around Linestrings
             else:
-                event_bbox = ""
-                event_dist = ""
-
-            if 'when' in req.params:
-                # limit search with fixed time
-                when = req.params['when'].upper()
-                event_when = "tstzrange(%s,%s,'[]')" % (self.relative_time(when,cur))
-            elif 'start' in req.params and 'stop' in req.params:
-                # limit search with fixed time (start to stop)
-                event_start, unused = self.relative_time(req.params['start'],cur)
-                unused, event_stop = self.relative_time(req.params['stop'],cur)
-                event_when = "tstzrange(%s,%s,'[]')" % (event_start, event_stop)
-            elif 'start' in req.params and 'stop' not in req.params:
-                # limit search with fixed time (start to now)
-                event_start, unused = self.relative_time(req.params['start'],cur)
-                event_when = "tstzrange(%s,now(),'[]')" % event_start
-            elif 'start' not in req.params and 'stop' in req.params:
-                # limit search with fixed time (now to stop)
-                unused, event_stop = self.relative_time(req.params['stop'],cur)
-                event_when = "tstzrange(now(),%s,'[]')" % event_stop
+              buffer = 0
+            if buffer == 0:
+              event_bbox = " AND ST_Intersects(geom, %s) " % geoj
             else:
-                event_when = "tstzrange(now(),now(),'[]')"
-
-            if 'what' in req.params:
-                # limit search based on "what"
-                event_what = cur.mogrify(" AND events_what LIKE %s AND events_what LIKE %s ", (req.params['what'][:4]+"%",req.params['what']+"%")).decode("utf-8")
+              event_bbox = " AND ST_DWithin(geom::geography, %s::geography, %s) " % (geoj, q.param(buffer, 'float8'))
+            event_sort_dist = "ST_Distance(geom::geography, %s::geography)::integer" % geoj
+            event_dist = event_sort_dist + " as distance, "
+            event_sort = "distance, " + event_sort
+        elif 'bbox' in req.params:
+            # limit search with bbox (E,S,W,N)
+            bbox = [q.param(c, 'float8') for c in req.params['bbox'].split(',')]
+            event_bbox = " AND geom && ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s),ST_Point(%s,%s)),4326) " % tuple(bbox)
+            event_dist = ""
+        elif 'near' in req.params:
+            # Limit search with location+distance
+            # (long, lat, distance in meters)
+            near = req.params['near'].split(',')
+            if len(near) < 3:
+                dist = 1
+            else:
+                dist = near[2]
+            point = "st_setsrid(st_makepoint(%s,%s),4326)::geography" % (q.param(near[0], 'float8'), q.param(near[1], 'float8'))
+            event_bbox = " AND ST_DWithin(geom::geography, %s, %s) " % (point, q.param(dist, 'float8'))
+            event_sort_dist = "ST_Distance(geom::geography, %s)::integer" % point
+            event_dist = event_sort_dist + " as distance, "
+            event_sort = "distance, " + event_sort
+        elif 'polyline' in req.params:
+            # use encoded polyline as search geometry
+            if 'buffer' in req.params:
+                buffer = float(req.params['buffer'])
             else:
-                event_what = ""
+                buffer = 1000
+            if 'polyline_precision' in req.params:
+                precision = int(req.params['polyline_precision'])
+            else:
+                precision = 5
+            line = "ST_SetSRID(ST_GeomFromGeoJSON(%s),4326)::geography" % q.param(
+                json.dumps(self.polyline_geometry(req.params['polyline'], precision, buffer)), 'text')
+            event_bbox = " AND ST_DWithin(geom::geography, %s, %s) " % (line, q.param(buffer, 'float8'))
+            event_dist = "ST_Distance(geom::geography, %s)::integer as distance, " % line
+        elif 'where:osm' in req.params:
+            event_bbox = " AND events_tags ? 'where:osm' AND events_tags->>'where:osm'=%s " % q.param(req.params['where:osm'], 'text')
+            event_dist = ""
+        elif 'where:wikidata' in req.params:
+            event_bbox = " AND events_tags ? 'where:wikidata' AND events_tags->>'where:wikidata'=%s " % q.param(req.params['where:wikidata'], 'text')
+            event_dist = ""
+        else:
+            event_bbox = ""
+            event_dist = ""
+
+        if 'when' in req.params:
+            # limit search with fixed time
+            when = req.params['when'].upper()
+            event_when = "tstzrange(%s,%s,'[]')" % (self.relative_time(when,q))
+        elif 'start' in req.params and 'stop' in req.params:
+            # limit search with fixed time (start to stop)
+            event_start, unused = self.relative_time(req.params['start'],q)
+            unused, event_stop = self.relative_time(req.params['stop'],q)
+            event_when = "tstzrange(%s,%s,'[]')" % (event_start, event_stop)
+        elif 'start' in req.params and 'stop' not in req.params:
+            # limit search with fixed time (start to now)
+            event_start, unused = self.relative_time(req.params['start'],q)
+            event_when = "tstzrange(%s,now(),'[]')" % event_start
+        elif 'start' not in req.params and 'stop' in req.params:
+            # limit search with fixed time (now to stop)
+            unused, event_stop = self.relative_time(req.params['stop'],q)
+            event_when = "tstzrange(now(),%s,'[]')" % event_stop
+        else:
+            event_when = "tstzrange(now(),now(),'[]')"
+
+        event_what = ""
+        if 'what' in req.params:
+            # limit search to "what" subtrees (what=traffic,weather.alert),
+            # subtrees starting with '-' are excluded
+            whats = self.param_list(req, 'what')
+            include = [w for w in whats if not w.startswith('-')]
+            exclude = [w[1:] for w in whats if w.startswith('-')]
+            if include:
+                event_what += " AND what_path(events_what) ? %s " % self.what_lqueries(q.param(include, 'text[]'))
+            if exclude:
+                event_what += " AND NOT what_path(events_what) ? %s " % self.what_lqueries(q.param(exclude, 'text[]'))
+
+        if 'type' in req.params:
+            # limit search based on type (scheduled, forecast, unscheduled)
+            event_type = " AND events_type = %s " % q.param(req.params['type'], 'text')
+        else:
+            event_type = ""
+
+        event_tags = self.tags_filter(req, q)
+
+        return dict(event_dist=event_dist, event_bbox=event_bbox, event_when=event_when,
+                    event_what=event_what, event_type=event_type, event_tags=event_tags,
+                    event_sort=event_sort, event_sort_dist=event_sort_dist,
+                    # events ending before the searched period are in partitions skipped by Postgres
+                    event_prune=" AND events_end >= coalesce(lower(%s), '-infinity') " % event_when)
+
+    def polyline_geometry(self, encoded, precision, buffer):
+        """Decode a search polyline, simplified well below the buffer (meters) around it."""
+        try:
+            coordinates = polyline.decode_polyline(encoded, precision)
+        except ValueError as err:
+            raise falcon.HTTPBadRequest(description='invalid polyline: %s' % err)
+        if not coordinates:
+            raise falcon.HTTPBadRequest(description='empty polyline')
+        # a tenth of the buffer, in degrees of latitude
+        coordinates = polyline.simplify(coordinates, buffer / 10 / 111320.0)
+        if len(coordinates) == 1:
+            return {"type": "Point", "coordinates": coordinates[0][::-1]}
+        return {"type": "LineString", "coordinates": [[lon, lat] for lat, lon in coordinates]}
+
+    def what_lqueries(self, whats):
+        # lquery[] matching the subtrees of the whats array, what_path is defined in setup.sql
+        return """ARRAY(SELECT (what_path(w)::text || '.*')::lquery FROM unnest({whats}) AS w
+                        WHERE what_path(w) <> '')""".format(whats=whats)
+
+    def tags_filter(self, req, q):
+        """Return the SQL condition on events_tags of tags=key,key=value,key=value1|value2.
+
+        Values are matched with @> ANY (jsonb_path_ops index), with one
+        object of all the key=value pairs per combination of alternative
+        values. Key presence (?&) is not indexed. The statement text does
+        not depend on the number of tags, it is prepared once.
+        """
+        keys = []
+        contains = [{}]
+        for tag in self.param_list(req, 'tags') or []:
+            key, sep, values = tag.partition('=')
+            if key == 'secret':
+                raise falcon.HTTPBadRequest(description="events can not be searched by secret")
+            if not sep:
+                keys.append(key)
+                continue
+            contains = [dict(c, **{key: v}) for c in contains for v in values.split('|')]
+            if len(contains) > TAGS_ALTERNATIVES:
+                raise falcon.HTTPBadRequest(description="too many combinations of tags values")
+        condition = ""
+        if contains != [{}]:
+            # sent as text[], array parameters of EXECUTE are not cast to jsonb[]
+            condition += " AND events_tags @> ANY(%s::jsonb[]) " % q.param([dumps(c) for c in contains], 'text[]')
+        if keys:
+            condition += " AND events_tags ?& %s " % q.param(keys, 'text[]')
+        return condition
+
+
+    def search_query(self, req, geom=None, validator=False):
+        """Build the event search statement, return (sql, params, geom_only).
 
-            if 'type' in req.params:
-                # limit search based on type (scheduled, forecast, unscheduled)
-                event_type = cur.mogrify(" AND events_type = %s ", (req.params['type'],)).decode("utf-8")
+        With validator, only the id and lastupdate of the matching events are
+        selected, for conditional requests.
+
+        A cursor (the next member of the previous page) restarts the search
+        after the last event of that page, in the (distance,) createdate, id
+        order of the results.
+        """
+        q = Query()
+        filters = self.search_filters(req, q, geom)
+
+        limit = "LIMIT %s" % q.param(self.page_limit(req), 'integer')
+
+        event_after = ""
+        if 'cursor' in req.params:
+            distance, createdate, id = self.decode_cursor(req.params['cursor'])
+            event_after = "(createdate, events_id) < (%s, %s)" % (q.param(createdate, 'timestamp'), q.param(id, 'uuid'))
+            if filters['event_sort_dist']:
+                if distance is None:
+                    raise falcon.HTTPBadRequest(description='cursor does not match this search')
+                distance = q.param(distance, 'integer')
+                event_after = "({dist} > {d} OR ({dist} = {d} AND {after}))".format(
+                    dist=filters['event_sort_dist'], d=distance, after=event_after)
+            event_after = " AND %s " % event_after
+
+        event_geom = "geom_center"
+        geom_only = False
+        if 'geom' in req.params:
+            if req.params['geom'] == 'full':
+                event_geom = "geom"
+            elif req.params['geom'] == 'only':
+                geom_only = True
+            elif req.params['geom'] == 'simplified':
+                event_geom = simplified_geom(req.get_param_as_float('tolerance', min_value=0.0000001, default=0.001))
             else:
-                event_type = ""
+                event_geom = "ST_SnapToGrid(geom,%s)" % q.param(req.params['geom'], 'float8')
+
+        event_tags = "events_tags"
+        fields = self.output_fields(req)
+        if fields is not None and not validator:
+            # only the requested tags are read
+            event_tags = """(SELECT coalesce(jsonb_object_agg(key, value), '{{}}') FROM jsonb_each(events_tags)
+                                WHERE key = ANY(%(fields)s::text[])) as events_tags"""
+            q.params['fields'] = fields
+
+        geometry = "st_asgeojson({event_geom})"
+        if req.get_param('output') == 'polyline':
+            # LineStrings as encoded polylines (JSON strings) instead of GeoJSON geometries
+            geometry = """CASE WHEN GeometryType({{event_geom}}) = 'LINESTRING'
+                            THEN to_json(ST_AsEncodedPolyline({{event_geom}}, {precision}))::text
+                            ELSE st_asgeojson({{event_geom}}) END""".format(
+                precision=q.param(req.get_param_as_int('polyline_precision', min_value=1, max_value=10, default=5), 'integer'))
 
-            if 'limit' in req.params:
-                limit = cur.mogrify("LIMIT %s", (req.params['limit'],)).decode("utf-8")
+        columns = "events_id, " + event_tags + ", createdate, lastupdate, {event_dist} " + geometry + " as geometry, st_x(geom_center) as lon, st_y(geom_center) as lat"
+        if validator:
+            columns = "{event_dist} events_id, lastupdate"
+
+        # Search recent active events.
+        sql = """SELECT """ + columns + """
+                    FROM events JOIN geo ON (hash=events_geo)
+                    WHERE events_when && {event_when} {event_prune} {event_what} {event_type} {event_tags} {event_bbox} {event_after}
+                    ORDER BY {event_sort} {limit}"""
+        # No user generated content here, values are passed as parameters.
+        return sql.format(event_geom=event_geom, limit=limit, event_after=event_after, **filters), q.params, geom_only
+
+    def aggregate_query(self, req, geom=None):
+        """Build the statement returning search results aggregated by cells (text FeatureCollection).
+
+        aggregate=grid groups events by cells of cell degrees (or of a size
+        matching zoom), aggregate=cluster in k-means clusters (clusters=k).
+        Each cell has the number of events, their centroid and their count
+        per 'what'.
+        """
+        q = Query()
+        filters = self.search_filters(req, q, geom)
+        if req.params['aggregate'] == 'cluster':
+            k = q.param(req.get_param_as_int('clusters', min_value=1, default=20), 'integer')
+            cell = "ST_ClusterKMeans(geom_center, LEAST(%s, (SELECT count(*) FROM matched)::integer)) OVER ()" % k
+        elif req.params['aggregate'] == 'grid':
+            if 'zoom' in req.params:
+                # about 64 pixels wide cells on 256 pixels tiles
+                size = 360.0 / 2 ** (req.get_param_as_int('zoom', min_value=0, max_value=24) + 2)
             else:
-                limit = "LIMIT 200"
-
-            event_geom = "geom_center"
-            geom_only = False
-            if 'geom' in req.params:
-                if req.params['geom'] == 'full':
-                    event_geom = "geom"
-                elif req.params['geom'] == 'only':
-                    geom_only = True
-                else:
-                    event_geom = cur.mogrify("ST_SnapToGrid(geom,%s)",(req.params['geom'],)).decode("utf-8")
+                size = req.get_param_as_float('cell', min_value=0.000001, default=0.1)
+            # exact (binary) comparison of the snapped points
+            cell = "ST_AsBinary(ST_SnapToGrid(geom_center, %s))" % q.param(size, 'float8')
+        else:
+            raise falcon.HTTPBadRequest(description="aggregate must be 'grid' or 'cluster'")
 
-            # Search recent active events.
-            sql = """SELECT events_id, events_tags, createdate, lastupdate, {event_dist} st_asgeojson({event_geom}) as geometry, st_x(geom_center) as lon, st_y(geom_center) as lat
-                        FROM events JOIN geo ON (hash=events_geo)
-                        WHERE events_when && {event_when} {event_what} {event_type} {event_bbox}
-                        ORDER BY {event_sort} {limit}"""
-            # No user generated content here, so format is safe.
-            sql = sql.format(event_dist=event_dist, event_geom=event_geom,
-                             event_bbox=event_bbox, event_what=event_what,
-                             event_when=event_when, event_type=event_type,
-                             event_sort=event_sort, limit=limit)
-            #print(sql)
-            cur.execute(sql)
-            resp.text = dumps(self.rows_to_collection(cur.fetchall(), geom_only))
-            resp.status = falcon.HTTP_200
+        sql = """WITH matched AS (SELECT events_what, geom_center
+                                    FROM events JOIN geo ON (hash=events_geo)
+                                    WHERE events_when && {event_when} {event_prune} {event_what} {event_type} {event_tags} {event_bbox}),
+                    cells AS (SELECT cell, coalesce(events_what, '') as what, count(*) as n,
+                                    sum(st_x(geom_center)) as sx, sum(st_y(geom_center)) as sy
+                                FROM (SELECT {cell} as cell, events_what, geom_center FROM matched) as m
+                                GROUP BY 1, 2)
+                SELECT json_build_object('type', 'FeatureCollection',
+                            'features', coalesce(json_agg(f.feature), '[]'),
+                            'count', count(*))::text
+                    FROM (SELECT json_build_object('type', 'Feature',
+                                    'geometry', st_asgeojson(st_setsrid(st_makepoint(sum(sx)/sum(n), sum(sy)/sum(n)),4326))::json,
+                                    'properties', json_build_object('count', sum(n), 'what', json_object_agg(what, n))) as feature
+                            FROM cells GROUP BY cell) as f"""
+        sql = sql.format(cell=cell, event_when=filters['event_when'], event_prune=filters['event_prune'], event_what=filters['event_what'],
+                         event_type=filters['event_type'], event_tags=filters['event_tags'],
+                         event_bbox=filters['event_bbox'])
+        return sql, q.params
+
+    def validator_query(self, req, id=None, geom=None):
+        """Return the (sql, params) of the (events_id, lastupdate) of the events of a read."""
+        if id is not None:
+            return "SELECT events_id, lastupdate FROM events WHERE events_id=%(id)s::uuid", dict(id=id)
+        # same rows as the search, without building the features
+        sql, params, geom_only = self.search_query(req, geom, validator=True)
+        return "SELECT events_id, lastupdate FROM ({sql}) AS r".format(sql=sql), params
+
+    def validators(self, req, rows, id=None, geom=None, tz=None):
+        """Return the (ETag, Last-Modified) of a read, from the (events_id, lastupdate) of its events.
+
+        Only single events have a Last-Modified date, lastupdate being in
+        the tz time zone: removed events would go unnoticed in searches.
+        """
+        digest = hashlib.md5()
+        if id is None:
+            # the same events found by another search are another representation
+            digest.update(dumps([sorted(req.params.items()), geom]).encode('utf-8'))
+        for events_id, lastupdate in rows:
+            digest.update(('%s %s,' % (events_id, lastupdate)).encode('utf-8'))
+        if id is None or not rows or rows[0][1] is None:
+            return digest.hexdigest(), None
+        return digest.hexdigest(), rows[0][1].replace(microsecond=0, tzinfo=tz)
+
+    def set_validators(self, resp, v):
+        resp.etag = v[0]
+        if v[1] is not None:
+            resp.last_modified = v[1].astimezone(timezone.utc)
+
+    def check_validators(self, req, resp, v):
+        """Set ETag/Last-Modified from v, return True (and 304) if the client copy is valid."""
+        if v is None:
+            return False
+        self.set_validators(resp, v)
+        if req.if_none_match is not None:
+            modified = not any(str(e) in (v[0], '*') for e in req.if_none_match)
         else:
-            # Get single event geojson Feature by id.
-            cur.execute("SELECT events_id, events_tags, createdate, lastupdate, st_asgeojson(geom) as geometry, st_x(geom_center) as lon, st_y(geom_center) as lat FROM events JOIN geo ON (hash=events_geo) WHERE events_id=%s", [id])
+            modified = (v[1] is None or req.if_modified_since is None
+                        or v[1] > req.if_modified_since)
+        if not modified:
+            resp.status = falcon.HTTP_304
+        return not modified
+
+    def conditional(self, req):
+        return req.method == 'GET' and (req.if_none_match is not None or req.if_modified_since is not None)
+
+    def not_modified(self, req, resp, id=None, geom=None):
+        """Return True (and 304) when the client copy of a conditional GET is still valid.
+
+        ETag and Last-Modified come from a cheap query, other reads get them
+        from the events they return.
+        """
+        if not self.conditional(req):
+            return False
+        with db_pool.connection() as db:
+            cur = db.cursor()
+            execute_prepared(cur, *self.validator_query(req, id, geom))
+            rows = cur.fetchall()
+            cur.close()
+            tz = db_timezone(db)
+        if id is not None and not rows:
+            return False
+        return self.check_validators(req, resp, self.validators(req, rows, id, geom, tz))
 
-            e = cur.fetchone()
-            if e is not None:
-                resp.text = dumps(self.row_to_feature(e))
+    def stream_collection(self, sql, params, geom_only=False, render_db=False, itersize=500, limit=None, fields=None):
+        """Return an iterator over a FeatureCollection serialized chunk by chunk.
+
+        Rows are read from a server side cursor, itersize at a time, and the
+        pooled connection is released once the iterator is exhausted or closed.
+        With render_db, features are already serialized by Postgres.
+        """
+        if render_db:
+            sql = self.feature_query(sql, geom_only, fields)
+        db = db_pool.getconn()
+        try:
+            cur = db.cursor(name='event_stream', cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute(sql, params)
+        except Exception:
+            db_pool.putconn(db)
+            raise
+
+        def chunks():
+            count = 0
+            key = None
+            try:
+                yield b'{"type": "FeatureCollection", "features": ['
+                while True:
+                    rows = cur.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield self.features_chunk(rows, count, geom_only, render_db, fields)
+                    count += len(rows)
+                    key = rows[-1][1] if render_db else self.page_key(rows[-1])
+                # count is only known once all rows have been sent
+                yield self.collection_end(count, key, limit)
+                cur.close()
+            finally:
+                db_pool.putconn(db)
+        return chunks()
+
+    def features_chunk(self, rows, count, geom_only=False, render_db=False, fields=None):
+        # serialized features, following count already sent ones
+        if render_db:
+            features = ', '.join(r[0] for r in rows)
+        else:
+            with timed('convert'):
+                features = [self.row_to_feature(r, geom_only, fields) for r in rows]
+            with timed('serialize'):
+                features = ', '.join(dumps(f) for f in features)
+        return ((', ' if count else '') + features).encode('utf-8')
+
+    def streaming(self, req):
+        # stream when asked for, or when a large result set is expected
+        return (req.get_param_as_bool('stream', default=False)
+                or self.page_limit(req) > STREAM_LIMIT)
+
+    def on_get(self, req, resp, id=None, geom=None):
+        if id is None and 'aggregate' in req.params:
+            sql, params = self.aggregate_query(req, geom)
+            with db_pool.connection() as db:
+                cur = db.cursor()
+                execute_prepared(cur, sql, params)
+                resp.data = cur.fetchone()[0].encode('utf-8')
+                cur.close()
+            resp.status = falcon.HTTP_200
+            return
+        if id is None and self.streaming(req):
+            # no ETag, it would be known once the whole response is sent
+            sql, params, geom_only = self.search_query(req, geom)
+            resp.stream = self.stream_collection(sql, params, geom_only, self.render_in_db(req),
+                                                 limit=self.page_limit(req), fields=self.output_fields(req))
+            resp.content_type = falcon.MEDIA_JSON
+            resp.status = falcon.HTTP_200
+            return
+        if self.not_modified(req, resp, id, geom):
+            return
+        render_db = self.render_in_db(req)
+        with db_pool.connection() as db:
+            cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            if id is None:
+                sql, params, geom_only = self.search_query(req, geom)
+                limit = self.page_limit(req)
+                fields = self.output_fields(req)
+                if render_db:
+                    execute_prepared(cur, self.collection_query(sql, geom_only, fields), params)
+                    row = cur.fetchone()
+                    resp.data = self.page_collection_text(row, limit).encode('utf-8')
+                    versions = list(zip(row[3] or [], row[4] or []))
+                else:
+                    execute_prepared(cur, sql, params)
+                    rows = cur.fetchall()
+                    with timed('convert'):
+                        collection = self.page_collection(rows, geom_only, limit, fields)
+                    with timed('serialize'):
+                        resp.text = dumps(collection)
+                    versions = [(r['events_id'], r['lastupdate']) for r in rows]
+                self.set_validators(resp, self.validators(req, versions, geom=geom))
                 resp.status = falcon.HTTP_200
             else:
-                resp.status = falcon.HTTP_404
-        db.close()
+                # Get single event geojson Feature by id.
+                sql = self.event_sql
+                if render_db:
+                    sql = self.feature_query(sql)
+                execute_prepared(cur, sql, dict(id=id))
+
+                e = cur.fetchone()
+                if e is None:
+                    resp.status = falcon.HTTP_404
+                elif render_db:
+                    resp.data = e[0].encode('utf-8')
+                    self.set_validators(resp, self.validators(req, [e[2:4]], id, tz=db_timezone(db)))
+                    resp.status = falcon.HTTP_200
+                else:
+                    resp.text = dumps(self.row_to_feature(e))
+                    self.set_validators(resp, self.validators(req, [(e['events_id'], e['lastupdate'])], id, tz=db_timezone(db)))
+                    resp.status = falcon.HTTP_200
 
     def insert_or_update(self, req, resp, id, query):
 
@@ -298,149 +1369,118 @@ class EventResource(BaseEvent):
             resp.status = falcon.HTTP_400
             return
 
-        resp.text = ''
-        if "properties" not in j:
-            resp.text = resp.text + "missing 'properties' elements\n"
-            j['properties'] = dict()
-        if "geometry" not in j:
-            resp.text = resp.text + "missing 'geometry' elements\n"
-            j['geometry'] = None
-        if "when" not in j['properties'] and ("start" not in j['properties'] or "stop" not in j['properties']) :
-            resp.text = resp.text + "missing 'when' or 'start/stop' in properties\n"
-            j['properties']['when'] = None
-        if "type" not in j['properties']:
-            resp.text = resp.text + "missing 'type' of event in properties\n"
-            j['properties']['type'] = None
-        if "what" not in j['properties']:
-            resp.text = resp.text + "missing 'what' in properties\n"
-            j['properties']['what'] = None
-        if "type" in j and j['type'] != 'Feature':
-            resp.text = resp.text + 'geojson must be "type":"Feature" only\n'
+        resp.text = self.check_feature(j)
         if id is None and resp.text != '':
             resp.status = falcon.HTTP_400
             resp.set_header('Content-type', 'text/plain')
             return
 
-        if 'when' in j['properties']:
-            event_when = j['properties']['when']
-        if "start" not in j['properties']:
-            event_start = j['properties']['when']
-        else:
-            event_start = j['properties']['start']
-        if "stop" not in j['properties']:
-            event_stop = j['properties']['when']
-        else:
-            event_stop = j['properties']['stop']
-        if not event_stop:
-            event_stop = event_start
-        if event_start == event_stop:
-            bounds = '[]'
-        else:
-            bounds = '[)'
+        event_start, event_stop, bounds = self.feature_when(j)
 
         # connect to db and insert
-        db = db_connect()
-        cur = db.cursor()
-
-        # 'secret' based authentication
-        if 'secret' in j['properties']:
-            secret = cur.mogrify(" AND (events_tags->>'secret' = %s OR events_tags->>'secret' IS NULL) ",(j['properties']['secret'],)).decode("utf-8")
-        elif 'secret' in req.params:
-            secret = cur.mogrify(" AND (events_tags->>'secret' = %s OR events_tags->>'secret' IS NULL) ",(req.params['secret'],)).decode("utf-8")
-        else:
-            secret = " AND events_tags->>'secret' IS NULL "
-
-        # get the geometry part
-        if j['geometry'] is not None:
-            geometry=dumps(j['geometry'])
-            h = self.maybe_insert_geometry(geometry,cur)
-            if len(h)>1 and h[1] is False:
-                resp.text = "invalid geometry: %s\n" % h[2]
-                resp.status = falcon.HTTP_400
-                resp.set_header('Content-type', 'text/plain')
-                return
-        else:
-            h = [None]
-        params = (j['properties']['type'], j['properties']['what'], event_start, event_stop, bounds, dumps(j['properties']), h[0])
-        if id:
-            params = params + (id,)
-        e = None
-        rows = None
-        try:
-            sql = cur.mogrify(query,params)
-            cur.execute(query.format(secret=secret), params)
-            rows = cur.rowcount
-            # get newly created event id
-            e = cur.fetchone()
-            db.commit()
-        except psycopg2.Error as err:
-            print(err, sql, err.pgerror)
-            db.rollback()
-            pass
+        with db_pool.connection() as db:
+            cur = db.cursor()
 
-        # send back to client
-        if e is None:
-          if id is None:
-              cur.execute("""SELECT events_id FROM events WHERE events_what=%s
-                      AND events_when=tstzrange(%s,%s,%s) AND events_geo=%s;""",
-                      (j['properties']['what'], event_start, event_stop, bounds, h[0]))
-          else:
-              if rows==0:
-                  if 'secret' in req.params or 'secret' in j['properties']:
-                      resp.status = '403 Unauthorized, secret does not match'
+            # 'secret' based authentication
+            if 'secret' in j['properties']:
+                secret = cur.mogrify(self.secret_sql,(j['properties']['secret'],)).decode("utf-8")
+            elif 'secret' in req.params:
+                secret = cur.mogrify(self.secret_sql,(req.params['secret'],)).decode("utf-8")
+            else:
+                secret = self.no_secret_sql
+
+            # a cached geometry missing from geo is inserted again, once
+            for retry in (True, False):
+                # get the geometry part
+                if j['geometry'] is not None:
+                    h = self.maybe_insert_geometry(j['geometry'],cur)
+                    if len(h)>1 and h[1] is False:
+                        resp.text = "invalid geometry: %s\n" % h[2]
+                        resp.status = falcon.HTTP_400
+                        resp.set_header('Content-type', 'text/plain')
+                        return
+                else:
+                    h = [None]
+                params = (j['properties']['type'], j['properties']['what'], event_start, event_stop, bounds, dumps(j['properties']), h[0])
+                if id:
+                    params = params + (id,)
+                e = None
+                rows = None
+                try:
+                    cur.execute(query.format(secret=secret), params)
+                    rows = cur.rowcount
+                    # get newly created event id
+                    e = cur.fetchone()
+                    db.commit()
+                    if j['geometry'] is not None:
+                        # the geometry is now committed in geo
+                        self.cache_geometry(j['geometry'], h[0])
+                except psycopg2.Error as err:
+                    # bound values are not logged, they contain the secret
+                    log.warning('event not stored: %s (%s)', err.diag.message_primary, err.pgcode)
+                    db.rollback()
+                    if retry and isinstance(err, psycopg2.errors.ForeignKeyViolation) and j['geometry'] is not None:
+                        geo_cache.discard(geometry_key(j['geometry']))
+                        continue
+                break
+
+            # send back to client
+            if e is None:
+              if id is None:
+                  cur.execute(self.duplicate_sql,
+                          (j['properties']['what'], event_start, event_stop, bounds, h[0]))
+              else:
+                  if rows==0:
+                      if 'secret' in req.params or 'secret' in j['properties']:
+                          resp.status = '403 Unauthorized, secret does not match'
+                      else:
+                          resp.status = '403 Unauthorized, secret required'
+                      return
                   else:
-                      resp.status = '403 Unauthorized, secret required'
-                  return
+                      cur.execute("END; " + self.patch_duplicate_sql,
+                          (id, j['properties']['what'], event_start, event_stop, bounds, h[0]))
+              dupe = cur.fetchone()
+              resp.text = """{"duplicate":"%s"}""" % (dupe[0])
+              resp.status = '409 Conflict with event %s' % dupe[0]
+            else:
+              resp.text = """{"id":"%s"}""" % (e[0])
+              if id is None:
+                  resp.status = falcon.HTTP_201
               else:
-                  cur.execute("""END; WITH s AS (SELECT * FROM events WHERE events_id = %s) SELECT e.events_id FROM events e, s WHERE e.events_what=coalesce(%s, s.events_what)
-                      AND e.events_when=tstzrange(coalesce(%s, lower(s.events_when)),coalesce(%s,upper(s.events_when)),%s) AND e.events_geo=coalesce(%s, s.events_geo);""",
-                      (id, j['properties']['what'], event_start, event_stop, bounds, h[0]))
-          dupe = cur.fetchone()
-          resp.text = """{"duplicate":"%s"}""" % (dupe[0])
-          resp.status = '409 Conflict with event %s' % dupe[0]
-        else:
-          resp.text = """{"id":"%s"}""" % (e[0])
-          if id is None:
-              resp.status = falcon.HTTP_201
-          else:
-              resp.status = falcon.HTTP_200
+                  resp.status = falcon.HTTP_200
 
-        cur.close()
-        db.close()
+            cur.close()
 
     def on_post(self, req, resp):
-        self.insert_or_update(req, resp, None, """INSERT INTO events ( events_type, events_what, events_when, events_tags, events_geo) VALUES (%s, %s, tstzrange(%s,%s,%s) , %s, %s) ON CONFLICT DO NOTHING RETURNING events_id;""")
+        self.insert_or_update(req, resp, None, self.insert_sql)
 
     def on_put(self, req, resp, id):
         # PUT is acting like PATCH
         event.on_patch(req, resp, id)
 
     def on_patch(self, req, resp, id):
-        # coalesce are used to PATCH the data (new value may be NULL to keep the old one)
-        self.insert_or_update(req, resp, id, """UPDATE events SET ( events_type, events_what, events_when, events_tags, events_geo) = (coalesce(%s, events_type), coalesce(%s, events_what), tstzrange(coalesce(%s, lower(events_when)),coalesce(%s, upper(events_when)),%s) , events_tags::jsonb || (%s::jsonb -'secret') , coalesce(%s, events_geo))
-                              WHERE events_id = %s {secret} RETURNING events_id;""")
+        self.insert_or_update(req, resp, id, self.update_sql)
 
     def on_delete(self, req, resp, id):
-        db = db_connect()
-        cur = db.cursor()
-        cur.execute("""INSERT INTO events_deleted SELECT events_id, createdate, lastupdate, events_type, events_what, events_when, events_geo, events_tags FROM events WHERE events_id = %s """, (id,));
-        rows_insert = cur.rowcount
-
-        # 'secret' based authentication, must be null or same as during POST
-        if 'secret' in req.params:
-            cur.execute("""DELETE FROM events WHERE events_id = %s AND (events_tags->>'secret' = %s OR events_tags->>'secret' IS NULL)""", (id,req.params['secret']));
-        else:
-            cur.execute("""DELETE FROM events WHERE events_id = %s AND events_tags->>'secret' IS NULL;""",(id,))
-        if cur.rowcount==1:
-            resp.status = "204 event deleted"
-            db.commit()
-        elif rows_insert==1: # INSERT ok but DELETE fails due to missing secret...
-            resp.status = "403 Unauthorized, secret needed to delete this event"
-            db.rollback()
-        else:
-            resp.status = "404 event not found"
-        cur.close()
-        db.close()
+        with db_pool.connection() as db:
+            cur = db.cursor()
+            cur.execute(self.archive_sql, (id,));
+            rows_insert = cur.rowcount
+
+            # 'secret' based authentication, must be null or same as during POST
+            if 'secret' in req.params:
+                cur.execute(self.delete_secret_sql, (id,req.params['secret']));
+            else:
+                cur.execute(self.delete_sql,(id,))
+            if cur.rowcount==1:
+                resp.status = "204 event deleted"
+                db.commit()
+            elif rows_insert==1: # INSERT ok but DELETE fails due to missing secret...
+                resp.status = "403 Unauthorized, secret needed to delete this event"
+                db.rollback()
+            else:
+                resp.status = "404 event not found"
+            cur.close()
 
 
 class EventSearch(BaseEvent):
@@ -453,16 +1493,492 @@ class EventSearch(BaseEvent):
         event.on_get(req, resp, None, j['geometry'])
 
 
+# web mercator (EPSG:3857) half width
+MERCATOR_MAX = 20037508.342789244
+
+
+class EventTiles(BaseEvent):
+    """Mapbox Vector Tiles of the events, with the same filters as searches."""
+
+    extent = 4096   # tile resolution
+    buffer = 64     # margin (tile units) around tiles, to avoid clipping artefacts
+
+    def __init__(self, cache_size, cache_ttl):
+        self.cache = LRUCache(cache_size)
+        self.cache_ttl = cache_ttl
+
+    def tile_query(self, req, z, x, y):
+        q = Query()
+        filters = event.search_filters(req, q)
+        size = 2 * MERCATOR_MAX / 2**z
+        xmin = -MERCATOR_MAX + x * size
+        ymax = MERCATOR_MAX - y * size
+        tile = "ST_MakeEnvelope(%s, %s, %s, %s, 3857)" % (
+            q.param(xmin, 'float8'), q.param(ymax - size, 'float8'),
+            q.param(xmin + size, 'float8'), q.param(ymax, 'float8'))
+        # start from the coarsest precomputed geometry finer than a tile pixel
+        source = "geom"
+        for tolerance, column in SIMPLIFY_LEVELS:
+            if tolerance <= 360.0 / 2**z / self.extent:
+                source = "coalesce(%s, geom)" % column
+        # geometries are simplified to the tile resolution before being clipped
+        sql = """SELECT ST_AsMVT(t, 'events', {extent}, 'geom') FROM
+                    (SELECT ST_AsMVTGeom(ST_Simplify(ST_Transform({source}, 3857), {tolerance}), {tile}, {extent}, {buffer}, true) AS geom,
+                            events_id::text as id, events_what as what, events_type as type, events_tags->>'label' as label,
+                            lower(events_when)::text as start, upper(events_when)::text as stop
+                        FROM events JOIN geo ON (hash=events_geo)
+                        WHERE geom && ST_Transform(ST_Expand({tile}, {margin}), 4326)
+                            AND events_when && {event_when} {event_prune} {event_what} {event_type} {event_tags} {event_bbox}) AS t"""
+        sql = sql.format(extent=self.extent, buffer=self.buffer, tile=tile, source=source,
+                         tolerance=q.param(size / self.extent, 'float8'),
+                         margin=q.param(size * self.buffer / self.extent, 'float8'),
+                         event_when=filters['event_when'], event_prune=filters['event_prune'],
+                         event_what=filters['event_what'], event_type=filters['event_type'],
+                         event_tags=filters['event_tags'], event_bbox=filters['event_bbox'])
+        return sql, q.params
+
+    def on_get(self, req, resp, z, x, y):
+        try:
+            z, x, y = int(z), int(x), int(y)
+        except ValueError:
+            raise falcon.HTTPNotFound()
+        if not (0 <= z <= 24 and 0 <= x < 2**z and 0 <= y < 2**z):
+            raise falcon.HTTPNotFound()
+
+        key = (z, x, y, tuple(sorted((k, str(v)) for k, v in req.params.items())))
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            tile = cached[1]
+        else:
+            sql, params = self.tile_query(req, z, x, y)
+            with db_pool.connection() as db:
+                cur = db.cursor()
+                execute_prepared(cur, sql, params)
+                tile = bytes(cur.fetchone()[0] or b'')
+                cur.close()
+            self.cache.put(key, (time.monotonic() + self.cache_ttl, tile))
+        resp.data = tile
+        resp.content_type = 'application/vnd.mapbox-vector-tile'
+        resp.status = falcon.HTTP_200
+
+
+class EventBulk(BaseEvent):
+    """Bulk event creation from a FeatureCollection or newline delimited GeoJSON.
+
+    Features are checked in python, distinct geometries and events are
+    loaded with COPY into temporary staging tables and merged into geo and
+    events in a single transaction.
+    """
+
+    def parse_features(self, body):
+        # return a list of (feature, error)
+        try:
+            j = json.loads(body)
+        except ValueError:
+            # newline delimited GeoJSON
+            features = []
+            for line in body.splitlines():
+                if line.strip() == '':
+                    continue
+                try:
+                    features.append((json.loads(line), None))
+                except ValueError:
+                    features.append((None, 'invalid json'))
+            return features
+        if isinstance(j, dict) and j.get('type') == 'FeatureCollection':
+            j = j.get('features', [])
+        elif not isinstance(j, list):
+            j = [j]
+        return [(f, None) for f in j]
+
+    def copy_value(self, value):
+        # COPY text format: None is \N, backslashes and separators are escaped
+        if value is None:
+            return '\\N'
+        return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+
+    def copy(self, cur, table, columns, rows):
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(self.copy_value(v) for v in row) + '\n')
+        data.seek(0)
+        cur.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), data)
+
+    def check_features(self, body):
+        """Return (results, events, geometries, cached) of the features of body.
+
+        results has an error for each invalid feature, None for the others
+        (events). Geometries not found in geo_cache are to be staged.
+        """
+        results = []
+        events = []     # (result index, feature, geometry key)
+        geometries = {} # geometry key (serialized geojson) -> staging id
+        cached = {}     # geometry key -> hash, for geometries found in geo_cache
+        for j, error in self.parse_features(body):
+            if error is None and not isinstance(j, dict):
+                error = 'geojson Feature expected'
+            if error is None and not isinstance(j.get('properties', {}), dict):
+                error = "'properties' must be an object"
+            if error is None:
+                error = self.check_feature(j).strip()
+            key = None
+            if not error and j['geometry'] is not None:
+                key = geometry_key(j['geometry'])
+                if key is None:
+                    error = 'invalid geometry'
+            if not error and re.search(r'(?<!\\)(\\\\)*\\u0000', dumps(j['properties'])):
+                # not accepted in text and jsonb values
+                error = 'invalid \\u0000 character in properties'
+            if error:
+                results.append({"error": error})
+                continue
+            if key is not None:
+                if key not in geometries and key not in cached:
+                    h = geo_cache.get(key)
+                    if h is not None:
+                        cached[key] = h
+                    else:
+                        geometries[key] = len(geometries)
+            results.append(None)
+            events.append((len(results) - 1, j, key))
+        return results, events, geometries, cached
+
+    def on_post(self, req, resp):
+        try:
+            body = req.stream.read().decode('utf-8')
+        except UnicodeDecodeError:
+            resp.text = 'bad encoding'
+            resp.status = falcon.HTTP_400
+            return
+
+        results, events, geometries, cached = self.check_features(body)
+        with db_pool.connection() as db:
+            cur = db.cursor()
+            try:
+                # geometries, each one is sent once, unless already known
+                geo_cache.warm_up(cur)
+                if cached:
+                    # cached hashes missing from geo (restored database) are staged again
+                    cur.execute("SELECT hash FROM geo WHERE hash = ANY(%s);", (list(set(cached.values())),))
+                    found = set(h for h, in cur.fetchall())
+                    for key, h in list(cached.items()):
+                        if h not in found:
+                            geo_cache.discard(key)
+                            del cached[key]
+                            geometries[key] = len(geometries)
+                cur.execute("""CREATE TEMP TABLE bulk_geo (n integer, geojson text) ON COMMIT DROP;""")
+                self.copy(cur, 'bulk_geo', ('n', 'geojson'), ((n, g) for g, n in geometries.items()))
+                # bulk_geometry and bulk_when (setup.sql) return NULL instead of
+                # failing, so that a bad feature does not abort the whole batch
+                cur.execute("""CREATE TEMP TABLE bulk_geo_hash ON COMMIT DROP AS
+                                SELECT n, geom, md5(st_astext(geom)) as hash, coalesce(ST_IsValid(geom), false) as valid,
+                                        coalesce(ST_IsValidReason(geom), 'not a GeoJSON geometry') as reason
+                                    FROM (SELECT n, bulk_geometry(geojson) as geom FROM bulk_geo) as g;""")
+                cur.execute("""INSERT INTO geo (""" + GEO_COLUMNS + """)
+                                SELECT geom, hash, st_centroid(geom) as geom_center, """ + GEO_SIMPLIFIED + """ FROM bulk_geo_hash
+                                    WHERE valid
+                                ON CONFLICT DO NOTHING;""")
+                cur.execute("""SELECT n, hash, valid, reason FROM bulk_geo_hash;""")
+                staged = {n: (h, valid, reason) for n, h, valid, reason in cur.fetchall()}
+                hashes = {key: staged[n] for key, n in geometries.items()}
+                hashes.update((key, (h, True, None)) for key, h in cached.items())
+
+                # events
+                rows = []
+                for i, j, key in events:
+                    h = None
+                    if key is not None:
+                        h, valid, reason = hashes[key]
+                        if not valid:
+                            results[i] = {"error": "invalid geometry: %s" % reason}
+                            continue
+                    event_start, event_stop, bounds = self.feature_when(j)
+                    rows.append((i, j['properties']['type'], j['properties']['what'],
+                                 event_start, event_stop, bounds, dumps(j['properties']), h))
+                cur.execute("""CREATE TEMP TABLE bulk_events (n integer, events_id uuid DEFAULT uuid_generate_v4(),
+                                    events_type text, events_what text, event_start text, event_stop text,
+                                    bounds text, events_tags jsonb, events_geo text, events_when tstzrange) ON COMMIT DROP;""")
+                self.copy(cur, 'bulk_events', ('n', 'events_type', 'events_what', 'event_start', 'event_stop', 'bounds', 'events_tags', 'events_geo'), rows)
+                cur.execute("""UPDATE bulk_events SET events_when = bulk_when(event_start, event_stop, bounds)
+                                RETURNING n, events_when IS NULL;""")
+                for i, invalid in cur.fetchall():
+                    if invalid:
+                        results[i] = {"error": "invalid 'when' or 'start/stop' dates"}
+                cur.execute("""INSERT INTO events (events_id, events_type, events_what, events_when, events_end, events_tags, events_geo)
+                                SELECT events_id, events_type, events_what, events_when,
+                                        coalesce(upper(events_when), 'infinity'), events_tags, events_geo
+                                    FROM bulk_events WHERE events_when IS NOT NULL ORDER BY n
+                                ON CONFLICT DO NOTHING RETURNING events_id;""")
+                created = set(e[0] for e in cur.fetchall())
+                # skipped events are duplicates, of existing events or of previous features
+                cur.execute("""SELECT b.n, b.events_id, e.events_id FROM bulk_events b
+                                LEFT JOIN events e ON (e.events_what=b.events_what
+                                    AND e.events_when=b.events_when
+                                    AND e.events_geo=b.events_geo)
+                                WHERE b.events_when IS NOT NULL;""")
+                for i, new_id, old_id in cur.fetchall():
+                    if new_id in created:
+                        results[i] = {"id": new_id}
+                    else:
+                        results[i] = {"duplicate": old_id}
+                db.commit()
+                for key, (h, valid, reason) in hashes.items():
+                    if valid:
+                        geo_cache.put(key, h)
+            except psycopg2.Error as err:
+                db.rollback()
+                resp.text = err.pgerror
+                resp.status = falcon.HTTP_400
+                resp.set_header('Content-type', 'text/plain')
+                return
+            cur.close()
+
+        summary = dict(created=0, duplicate=0, error=0)
+        for r in results:
+            summary['created' if 'id' in r else 'duplicate' if 'duplicate' in r else 'error'] += 1
+        resp.text = dumps(dict(summary, results=results))
+        resp.status = falcon.HTTP_200
+
+
+class EventWhat:
+    """Number of events per 'what' category, as a tree of the dotted categories.
+
+    Counts come from the events_what_stats materialized view, refreshed
+    when older than max_age seconds.
+    """
+
+    what_sql = "SELECT what, count, active FROM events_what_stats;"
+
+    def __init__(self, ttl, max_age):
+        self.max_age = max_age
+        self.cache = CachedValue(self.compute, ttl)
+
+    def compute(self):
+        with db_pool.connection() as db:
+            refresh_summary(db, 'events_what_stats', self.max_age)
+            cur = db.cursor()
+            cur.execute(self.what_sql)
+            rows = cur.fetchall()
+            cur.close()
+        # counts of a category include the ones of its subcategories
+        tree = {}
+        for what, count, active in rows:
+            children = tree
+            for label in what.split('.'):
+                node = children.setdefault(label, dict(count=0, active=0, children={}))
+                node['count'] += count
+                node['active'] += active
+                children = node['children']
+        return dumps(tree)
+
+    def on_get(self, req, resp):
+        resp.text = self.cache.get()
+        resp.status = falcon.HTTP_200
+
+
+class EventChanges(BaseEvent):
+    """Feed of created, updated and deleted events, in lastupdate order.
+
+    lastupdate and deletedate are the start time of the writing
+    transaction, so changes are only returned once older than the oldest
+    running write transaction of the database (and than lag seconds):
+    events committed after a read, with an earlier lastupdate, are not
+    skipped. Deleted events are features without geometry, with a
+    'deleted' date.
+    """
+
+    channel = 'events_changes'  # notified by the events_notify trigger
+    keepalive = 15              # seconds between SSE comments
+    # Write transactions of the backend get a transaction id with their
+    # first statement. Sessions of other users are only seen by members of
+    # pg_read_all_stats.
+    # Each part is read in index order, after the (date, id) of the last change sent
+    changes_sql = """WITH horizon AS (SELECT least(localtimestamp - %(lag)s::float8 * interval '1 second',
+                                        (SELECT min(xact_start)::timestamp FROM pg_stat_activity
+                                            WHERE datname = current_database() AND backend_xid IS NOT NULL
+                                                AND pid <> pg_backend_pid())) AS h)
+                    SELECT * FROM (
+                        (SELECT events_id, events_tags, createdate, lastupdate, lastupdate as changed, false as deleted,
+                                st_asgeojson(geom) as geometry, st_x(geom_center) as lon, st_y(geom_center) as lat
+                            FROM events JOIN geo ON (hash=events_geo)
+                            WHERE lastupdate >= %(since)s::timestamp
+                                AND (lastupdate, events_id) > (%(since)s::timestamp, %(id)s::uuid)
+                                AND lastupdate < (SELECT h FROM horizon)
+                            ORDER BY lastupdate, events_id LIMIT %(limit)s::integer)
+                        UNION ALL
+                        (SELECT events_id, NULL, createdate, lastupdate, deletedate, true, NULL, NULL, NULL
+                            FROM events_deleted
+                            WHERE (deletedate, events_id) > (%(since)s::timestamp, %(id)s::uuid)
+                                AND deletedate < (SELECT h FROM horizon)
+                            ORDER BY deletedate, events_id LIMIT %(limit)s::integer)) AS c
+                    ORDER BY changed, events_id LIMIT %(limit)s::integer"""
+
+    def __init__(self, lag, max_wait, sse_timeout, max_listeners):
+        self.lag = lag
+        self.max_wait = max_wait
+        self.sse_timeout = sse_timeout
+        self.max_listeners = max_listeners
+
+    def since(self, req):
+        """Return the [date, id] key changes are read after.
+
+        since is the next member of a previous response (or the id of the
+        last SSE message), or a timestamp.
+        """
+        since = req.get_header('Last-Event-ID') or req.get_param('since')
+        if since is None:
+            return ['-infinity', '00000000-0000-0000-0000-000000000000']
+        if re.match(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}', since):
+            return [since, '00000000-0000-0000-0000-000000000000']
+        try:
+            date, id = json.loads(base64.urlsafe_b64decode(since + '=' * (-len(since) % 4)))
+        except (ValueError, TypeError):
+            raise falcon.HTTPBadRequest(description='invalid since token')
+        return [date, id]
+
+    def read(self, key, limit):
+        with db_pool.connection() as db:
+            cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            execute_prepared(cur, self.changes_sql, dict(since=key[0], id=key[1], lag=self.lag, limit=limit))
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+
+    def change_to_feature(self, row):
+        if row['deleted']:
+            return {
+                "type": "Feature",
+                "geometry": None,
+                "properties": {"id": row['events_id'], "deleted": row['changed']}
+            }
+        return self.row_to_feature(row)
+
+    def listen(self):
+        """Return a dedicated connection listening to the changes, None if max_listeners are already waiting.
+
+        Waiting clients hold a worker of this (sync) app and a connection,
+        their number is limited across all workers by session advisory
+        locks, released when the connection is closed. max_listeners is 0
+        by default: SSE and wait= are meant for the ASGI app.
+        """
+        if self.max_listeners <= 0:
+            return None
+        listener = db_connect()
+        listener.autocommit = True
+        cur = listener.cursor()
+        for slot in range(self.max_listeners):
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s::integer);", (self.channel, slot))
+            if cur.fetchone()[0]:
+                cur.execute('LISTEN %s' % self.channel)
+                return listener
+        listener.close()
+        return None
+
+    def notified(self, listener, timeout):
+        """Wait up to timeout seconds for a notification on listener."""
+        if select.select([listener], [], [], timeout) == ([], [], []):
+            return False
+        listener.poll()
+        del listener.notifies[:]
+        return True
+
+    def wait_changes(self, key, limit, listener, deadline):
+        """Read changes after key, waiting for new ones until deadline."""
+        while True:
+            rows = self.read(key, limit)
+            remaining = deadline - time.time()
+            if rows or remaining <= 0:
+                return rows
+            # notified changes can be read lag seconds later, the ones
+            # committed before LISTEN are found by the next read
+            if self.notified(listener, min(remaining, self.lag or remaining)):
+                time.sleep(min(self.lag, max(0, deadline - time.time())))
+
+    def server_sent_events(self, key, limit, listener):
+        """Return an iterator over changes sent as server-sent events, closing listener once done."""
+        def messages(key):
+            try:
+                end = time.time() + self.sse_timeout
+                while time.time() < end:
+                    rows = self.wait_changes(key, limit, listener, min(end, time.time() + self.keepalive))
+                    if not rows:
+                        yield b': keepalive\n\n'
+                    for r in rows:
+                        key = [r['changed'], r['events_id']]
+                        yield self.message(r)
+            finally:
+                listener.close()
+        return messages(key)
+
+    def on_get(self, req, resp):
+        key = self.since(req)
+        limit = req.get_param_as_int('limit', min_value=1, max_value=10000, default=1000)
+        resp.cache_control = ['no-cache']
+        if req.client_accepts('text/event-stream') and not req.client_accepts_json:
+            listener = self.listen()
+            if listener is None:
+                if self.max_listeners <= 0:
+                    raise falcon.HTTPServiceUnavailable(description='server-sent events are not enabled on this server')
+                raise falcon.HTTPServiceUnavailable(description='too many clients waiting for changes',
+                                                    retry_after=self.keepalive)
+            # clients reconnect after sse_timeout, with the Last-Event-ID header
+            resp.content_type = 'text/event-stream'
+            resp.stream = self.server_sent_events(key, limit, listener)
+            resp.status = falcon.HTTP_200
+            return
+        wait = req.get_param_as_int('wait', min_value=0, max_value=self.max_wait, default=0)
+        # without a free listener, changes are returned without waiting
+        listener = self.listen() if wait else None
+        if listener is not None:
+            try:
+                rows = self.wait_changes(key, limit, listener, time.time() + wait)
+            finally:
+                listener.close()
+        else:
+            rows = self.read(key, limit)
+        resp.text = self.changes_collection(rows, key)
+        resp.status = falcon.HTTP_200
+
+    def message(self, row):
+        # server-sent event of a change, its id is the since token of the next one
+        key = [row['changed'], row['events_id']]
+        return ('id: %s\ndata: %s\n\n' % (self.encode_cursor(key), dumps(self.change_to_feature(row)))).encode('utf-8')
+
+    def changes_collection(self, rows, key):
+        """FeatureCollection (text) of the changes read after key."""
+        if rows:
+            key = [rows[-1]['changed'], rows[-1]['events_id']]
+        return dumps({
+            "type": "FeatureCollection",
+            "features": [self.change_to_feature(r) for r in rows],
+            "count": len(rows),
+            "next": self.encode_cursor(key)
+        })
+
+
 # Falcon.API instances are callable WSGI apps.
-app = falcon.App(middleware=[HeaderMiddleware()])
+app = falcon.App(middleware=[MetricsMiddleware(), HeaderMiddleware(), CacheMiddleware(int(os.getenv("CACHE_MAX_AGE", 60)))])
 
 # Resources are represented by long-lived class instances
 event = EventResource()
 stats = StatsResource()
 event_search = EventSearch()
+event_bulk = EventBulk()
+event_tiles = EventTiles(int(os.getenv("TILE_CACHE_SIZE", 1000)), float(os.getenv("TILE_CACHE_TTL", 60)))
+metrics_resource = MetricsResource()
+event_what = EventWhat(float(os.getenv("WHAT_CACHE_TTL", 60)), float(os.getenv("WHAT_MAX_AGE", 300)))
+event_changes = EventChanges(float(os.getenv("CHANGES_LAG", 2)), int(os.getenv("CHANGES_MAX_WAIT", 60)),
+                             int(os.getenv("CHANGES_SSE_TIMEOUT", 300)), int(os.getenv("CHANGES_MAX_LISTENERS", 0)))
 
 # things will handle all requests to the matching URL path
 app.add_route('/event/{id}', event)  # handle single event requests
 app.add_route('/event', event)  # handle single event requests
 app.add_route('/stats', stats)
 app.add_route('/event/search', event_search)
+app.add_route('/event/bulk', event_bulk)
+app.add_route('/event/tiles/{z}/{x}/{y}.mvt', event_tiles)
+app.add_route('/event/changes', event_changes)
+app.add_route('/event/what', event_what)
+app.add_route('/metrics', metrics_resource)
+app.add_route('/metrics/slow', metrics_resource, suffix='slow')
@@ -0,0 +1,465 @@
+# backend_asgi.py
+# openeventdatabase, ASGI variant of backend.py
+#
+# Same resources, validation and SQL as the WSGI app, served by an
+# asyncio server with the async psycopg (3) driver:
+#
+#   uvicorn backend_asgi:app --port 8080
+
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import os
+import time
+
+import falcon
+import falcon.asgi
+import psycopg
+import psycopg.conninfo
+import psycopg.rows
+import psycopg_pool
+
+import backend
+from backend import dumps, geo_cache, geometry_key, system_uptime
+
+
+class ConnectionPool:
+    """Async pool of database connections, opened with the application.
+
+    psycopg prepares statements executed more than DB_PREPARE_THRESHOLD
+    times on a connection, which is what the stable statements built by
+    EventResource.search_query are made for.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, max_lifetime=3600, timeout=10, prepare_threshold=1):
+        params = dict((k, v) for k, v in backend.db_params().items() if v)
+        self.conninfo = psycopg.conninfo.make_conninfo(**params)
+        self.pool = psycopg_pool.AsyncConnectionPool(
+            self.conninfo,
+            min_size=minconn, max_size=maxconn,
+            max_lifetime=max_lifetime, timeout=timeout,
+            check=psycopg_pool.AsyncConnectionPool.check_connection,
+            kwargs=dict(prepare_threshold=prepare_threshold),
+            open=False)
+
+    async def process_startup(self, scope, event):
+        await self.pool.open()
+
+    async def process_shutdown(self, scope, event):
+        await self.pool.close()
+
+    async def getconn(self):
+        try:
+            return await self.pool.getconn()
+        except psycopg_pool.PoolTimeout:
+            raise falcon.HTTPServiceUnavailable(description='database connection pool exhausted')
+
+    async def putconn(self, db):
+        if not db.closed and db.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            # uncommitted work is never handed over to the next borrower
+            try:
+                await db.rollback()
+            except psycopg.Error:
+                pass
+        await self.pool.putconn(db)
+
+    @asynccontextmanager
+    async def connection(self):
+        db = await self.getconn()
+        try:
+            yield db
+        finally:
+            await self.putconn(db)
+
+    def stats(self):
+        return self.pool.get_stats()
+
+
+db_pool = ConnectionPool(
+    minconn=int(os.getenv("DB_POOL_MIN", 1)),
+    maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+    max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", 3600)),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),
+    prepare_threshold=int(os.getenv("DB_PREPARE_THRESHOLD", 1)))
+
+
+async def refresh_summary(db, view, max_age):
+    # see backend.refresh_summary
+    cur = await db.execute("SELECT extract(epoch FROM now() - max(refreshed)) FROM %s;" % view)
+    age = (await cur.fetchone())[0]
+    if age is None or age > max_age:
+        cur = await db.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s));", (view,))
+        if (await cur.fetchone())[0]:
+            await db.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY %s;" % view)
+        await db.commit()
+
+
+class StatsResource(backend.StatsResource):
+    def __init__(self):
+        self.ttl = float(os.getenv("STATS_CACHE_TTL", 60))
+        self.lock = asyncio.Lock()
+        self.value = None
+        self.expires = 0
+
+    async def compute(self):
+        async with db_pool.connection() as db:
+            await refresh_summary(db, 'events_stats', float(os.getenv("STATS_MAX_AGE", 300)))
+            count = (await (await db.execute(self.count_sql)).fetchone())[0]
+            last, pg_uptime = await (await db.execute(self.info_sql)).fetchone()
+            recent = await (await db.execute(self.recent_sql)).fetchall()
+        return dict(events_count=count, last_updated=last, db_uptime=pg_uptime, recent=recent)
+
+    async def on_get(self, req, resp):
+        # while the value is recomputed, the previous one is served
+        if time.monotonic() >= self.expires and not (self.lock.locked() and self.value is not None):
+            async with self.lock:
+                if time.monotonic() >= self.expires:
+                    self.value = await self.compute()
+                    self.expires = time.monotonic() + self.ttl
+        resp.text = dumps(dict(self.value, uptime=system_uptime(), pool=db_pool.stats(), geo_cache=geo_cache.stats()))
+        resp.status = falcon.HTTP_200
+
+
+class EventResource(backend.EventResource):
+
+    async def maybe_insert_geometry(self, geometry, cur):
+        # see backend.EventResource.maybe_insert_geometry
+        key = geometry_key(geometry)
+        h = geo_cache.get(key) if key is not None else None
+        if h is not None:
+            return (h,)
+        geometry = dumps(geometry)
+        await cur.execute(self.geo_insert_sql, (geometry,))
+        h = await cur.fetchone()
+        if h is None:
+            await cur.execute(self.geo_check_sql, (geometry,))
+            h = await cur.fetchone()
+        return h
+
+    async def stream_collection(self, sql, params, geom_only=False, render_db=False, itersize=500, limit=None, fields=None):
+        """Return an async iterator over a FeatureCollection serialized chunk by chunk."""
+        if render_db:
+            sql = self.feature_query(sql, geom_only, fields)
+        db = await db_pool.getconn()
+        try:
+            cur = db.cursor(name='event_stream', row_factory=psycopg.rows.tuple_row if render_db else psycopg.rows.dict_row)
+            await cur.execute(sql, params)
+        except Exception:
+            await db_pool.putconn(db)
+            raise
+
+        async def chunks():
+            count = 0
+            key = None
+            try:
+                yield b'{"type": "FeatureCollection", "features": ['
+                while True:
+                    rows = await cur.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield self.features_chunk(rows, count, geom_only, render_db, fields)
+                    count += len(rows)
+                    key = rows[-1][1] if render_db else self.page_key(rows[-1])
+                # count is only known once all rows have been sent
+                yield self.collection_end(count, key, limit)
+                await cur.close()
+            finally:
+                await db_pool.putconn(db)
+        return chunks()
+
+    async def on_get(self, req, resp, id=None, geom=None):
+        if id is None and 'aggregate' in req.params:
+            sql, params = self.aggregate_query(req, geom)
+            async with db_pool.connection() as db:
+                cur = await db.execute(sql, params)
+                resp.data = (await cur.fetchone())[0].encode('utf-8')
+            resp.status = falcon.HTTP_200
+            return
+        render_db = self.render_in_db(req)
+        if id is None and self.streaming(req):
+            # no ETag, see backend.EventResource.on_get
+            sql, params, geom_only = self.search_query(req, geom)
+            resp.stream = await self.stream_collection(sql, params, geom_only, render_db,
+                                                       limit=self.page_limit(req), fields=self.output_fields(req))
+            resp.content_type = falcon.MEDIA_JSON
+            resp.status = falcon.HTTP_200
+            return
+        if self.conditional(req):
+            async with db_pool.connection() as db:
+                cur = await db.execute(*self.validator_query(req, id, geom))
+                rows = await cur.fetchall()
+                tz = db.info.timezone
+            if (id is None or rows) and self.check_validators(req, resp, self.validators(req, rows, id, geom, tz)):
+                return
+        async with db_pool.connection() as db:
+            cur = db.cursor(row_factory=psycopg.rows.tuple_row if render_db else psycopg.rows.dict_row)
+            if id is None:
+                sql, params, geom_only = self.search_query(req, geom)
+                limit = self.page_limit(req)
+                fields = self.output_fields(req)
+                if render_db:
+                    await cur.execute(self.collection_query(sql, geom_only, fields), params)
+                    row = await cur.fetchone()
+                    resp.data = self.page_collection_text(row, limit).encode('utf-8')
+                    versions = list(zip(row[3] or [], row[4] or []))
+                else:
+                    await cur.execute(sql, params)
+                    rows = await cur.fetchall()
+                    resp.text = dumps(self.page_collection(rows, geom_only, limit, fields))
+                    versions = [(r['events_id'], r['lastupdate']) for r in rows]
+                self.set_validators(resp, self.validators(req, versions, geom=geom))
+                resp.status = falcon.HTTP_200
+            else:
+                # Get single event geojson Feature by id.
+                sql = self.event_sql
+                if render_db:
+                    sql = self.feature_query(sql)
+                await cur.execute(sql, dict(id=id))
+
+                e = await cur.fetchone()
+                if e is None:
+                    resp.status = falcon.HTTP_404
+                elif render_db:
+                    resp.data = e[0].encode('utf-8')
+                    self.set_validators(resp, self.validators(req, [e[2:4]], id, tz=db.info.timezone))
+                    resp.status = falcon.HTTP_200
+                else:
+                    resp.text = dumps(self.row_to_feature(e))
+                    self.set_validators(resp, self.validators(req, [(e['events_id'], e['lastupdate'])], id, tz=db.info.timezone))
+                    resp.status = falcon.HTTP_200
+
+    async def insert_or_update(self, req, resp, id, query):
+        # see backend.EventResource.insert_or_update
+
+        # get request body payload (geojson Feature)
+        try:
+            body = (await req.stream.read()).decode('utf-8')
+            j = json.loads(body)
+        except:
+            resp.text = 'invalid json or bad encoding'
+            resp.status = falcon.HTTP_400
+            return
+
+        resp.text = self.check_feature(j)
+        if id is None and resp.text != '':
+            resp.status = falcon.HTTP_400
+            resp.set_header('Content-type', 'text/plain')
+            return
+
+        event_start, event_stop, bounds = self.feature_when(j)
+
+        async with db_pool.connection() as db:
+            # client side binding, like psycopg2, for the shared statements
+            cur = psycopg.AsyncClientCursor(db)
+
+            # 'secret' based authentication
+            if 'secret' in j['properties']:
+                secret = cur.mogrify(self.secret_sql,(j['properties']['secret'],))
+            elif 'secret' in req.params:
+                secret = cur.mogrify(self.secret_sql,(req.params['secret'],))
+            else:
+                secret = self.no_secret_sql
+
+            # a cached geometry missing from geo is inserted again, once
+            for retry in (True, False):
+                # get the geometry part
+                if j['geometry'] is not None:
+                    h = await self.maybe_insert_geometry(j['geometry'],cur)
+                    if len(h)>1 and h[1] is False:
+                        resp.text = "invalid geometry: %s\n" % h[2]
+                        resp.status = falcon.HTTP_400
+                        resp.set_header('Content-type', 'text/plain')
+                        return
+                else:
+                    h = [None]
+                params = (j['properties']['type'], j['properties']['what'], event_start, event_stop, bounds, dumps(j['properties']), h[0])
+                if id:
+                    params = params + (id,)
+                e = None
+                rows = None
+                try:
+                    await cur.execute(query.format(secret=secret), params)
+                    rows = cur.rowcount
+                    # get newly created event id
+                    e = await cur.fetchone()
+                    await db.commit()
+                    if j['geometry'] is not None:
+                        # the geometry is now committed in geo
+                        self.cache_geometry(j['geometry'], h[0])
+                except psycopg.Error as err:
+                    # bound values are not logged, they contain the secret
+                    backend.log.warning('event not stored: %s (%s)', err.diag.message_primary, err.sqlstate)
+                    await db.rollback()
+                    if retry and isinstance(err, psycopg.errors.ForeignKeyViolation) and j['geometry'] is not None:
+                        geo_cache.discard(geometry_key(j['geometry']))
+                        continue
+                break
+
+            # send back to client
+            if e is None:
+                if id is None:
+                    await cur.execute(self.duplicate_sql,
+                            (j['properties']['what'], event_start, event_stop, bounds, h[0]))
+                else:
+                    if rows==0:
+                        if 'secret' in req.params or 'secret' in j['properties']:
+                            resp.status = '403 Unauthorized, secret does not match'
+                        else:
+                            resp.status = '403 Unauthorized, secret required'
+                        return
+                    else:
+                        await cur.execute(self.patch_duplicate_sql,
+                            (id, j['properties']['what'], event_start, event_stop, bounds, h[0]))
+                dupe = await cur.fetchone()
+                resp.text = """{"duplicate":"%s"}""" % (dupe[0])
+                resp.status = '409 Conflict with event %s' % dupe[0]
+            else:
+                resp.text = """{"id":"%s"}""" % (e[0])
+                if id is None:
+                    resp.status = falcon.HTTP_201
+                else:
+                    resp.status = falcon.HTTP_200
+
+            await cur.close()
+
+    async def on_post(self, req, resp):
+        await self.insert_or_update(req, resp, None, self.insert_sql)
+
+    async def on_put(self, req, resp, id):
+        # PUT is acting like PATCH
+        await self.on_patch(req, resp, id)
+
+    async def on_patch(self, req, resp, id):
+        await self.insert_or_update(req, resp, id, self.update_sql)
+
+    async def on_delete(self, req, resp, id):
+        async with db_pool.connection() as db:
+            cur = db.cursor()
+            await cur.execute(self.archive_sql, (id,))
+            rows_insert = cur.rowcount
+
+            # 'secret' based authentication, must be null or same as during POST
+            if 'secret' in req.params:
+                await cur.execute(self.delete_secret_sql, (id,req.params['secret']))
+            else:
+                await cur.execute(self.delete_sql,(id,))
+            if cur.rowcount==1:
+                resp.status = "204 event deleted"
+                await db.commit()
+            elif rows_insert==1: # INSERT ok but DELETE fails due to missing secret...
+                resp.status = "403 Unauthorized, secret needed to delete this event"
+                await db.rollback()
+            else:
+                resp.status = "404 event not found"
+            await cur.close()
+
+
+class EventSearch(backend.BaseEvent):
+
+    async def on_post(self, req, resp):
+        # body should contain a geojson Feature
+        body = (await req.stream.read()).decode('utf-8')
+        j = json.loads(body)
+        # pass the query with the geometry to event.on_get
+        await event.on_get(req, resp, None, j['geometry'])
+
+
+class EventChanges(backend.EventChanges):
+    """Change feed, see backend.EventChanges.
+
+    Clients waiting for changes (SSE and wait=) only hold a dedicated
+    connection here, not a worker.
+    """
+
+    async def read(self, key, limit):
+        async with db_pool.connection() as db:
+            cur = db.cursor(row_factory=psycopg.rows.dict_row)
+            await cur.execute(self.changes_sql, dict(since=key[0], id=key[1], lag=self.lag, limit=limit))
+            return await cur.fetchall()
+
+    async def listen(self):
+        # see backend.EventChanges.listen, the advisory locks are shared with the sync app
+        if self.max_listeners <= 0:
+            return None
+        listener = await psycopg.AsyncConnection.connect(db_pool.conninfo, autocommit=True)
+        for slot in range(self.max_listeners):
+            cur = await listener.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s::integer);", (self.channel, slot))
+            if (await cur.fetchone())[0]:
+                await listener.execute('LISTEN %s' % self.channel)
+                return listener
+        await listener.close()
+        return None
+
+    async def notified(self, listener, timeout):
+        """Wait up to timeout seconds for a notification on listener."""
+        async for n in listener.notifies(timeout=timeout, stop_after=1):
+            return True
+        return False
+
+    async def wait_changes(self, key, limit, listener, deadline):
+        # see backend.EventChanges.wait_changes
+        while True:
+            rows = await self.read(key, limit)
+            remaining = deadline - time.time()
+            if rows or remaining <= 0:
+                return rows
+            if await self.notified(listener, min(remaining, self.lag or remaining)):
+                await asyncio.sleep(min(self.lag, max(0, deadline - time.time())))
+
+    def server_sent_events(self, key, limit, listener):
+        """Return an async iterator over changes sent as server-sent events, closing listener once done."""
+        async def messages(key):
+            try:
+                end = time.time() + self.sse_timeout
+                while time.time() < end:
+                    rows = await self.wait_changes(key, limit, listener, min(end, time.time() + self.keepalive))
+                    if not rows:
+                        yield b': keepalive\n\n'
+                    for r in rows:
+                        key = [r['changed'], r['events_id']]
+                        yield self.message(r)
+            finally:
+                await listener.close()
+        return messages(key)
+
+    async def on_get(self, req, resp):
+        key = self.since(req)
+        limit = req.get_param_as_int('limit', min_value=1, max_value=10000, default=1000)
+        resp.cache_control = ['no-cache']
+        if req.client_accepts('text/event-stream') and not req.client_accepts_json:
+            listener = await self.listen()
+            if listener is None:
+                raise falcon.HTTPServiceUnavailable(description='too many clients waiting for changes',
+                                                    retry_after=self.keepalive)
+            # clients reconnect after sse_timeout, with the Last-Event-ID header
+            resp.content_type = 'text/event-stream'
+            resp.stream = self.server_sent_events(key, limit, listener)
+            resp.status = falcon.HTTP_200
+            return
+        wait = req.get_param_as_int('wait', min_value=0, max_value=self.max_wait, default=0)
+        # without a free listener, changes are returned without waiting
+        listener = await self.listen() if wait else None
+        if listener is not None:
+            try:
+                rows = await self.wait_changes(key, limit, listener, time.time() + wait)
+            finally:
+                await listener.close()
+        else:
+            rows = await self.read(key, limit)
+        resp.text = self.changes_collection(rows, key)
+        resp.status = falcon.HTTP_200
+
+
+app = falcon.asgi.App(middleware=[db_pool, backend.HeaderMiddleware(), backend.CacheMiddleware(int(os.getenv("CACHE_MAX_AGE", 60)))])
+
+event = EventResource()
+stats = StatsResource()
+event_search = EventSearch()
+event_changes = EventChanges(float(os.getenv("CHANGES_LAG", 2)), int(os.getenv("CHANGES_MAX_WAIT", 60)),
+                             int(os.getenv("CHANGES_SSE_TIMEOUT", 300)), int(os.getenv("CHANGES_MAX_LISTENERS", 100)))
+
+app.add_route('/event/{id}', event)  # handle single event requests
+app.add_route('/event', event)  # handle single event requests
+app.add_route('/stats', stats)
+app.add_route('/event/search', event_search)
+app.add_route('/event/changes', event_changes)
@@ -0,0 +1,110 @@
+# bench/load.py
+# openeventdatabase, load test of running backends
+#
+# Sends the same requests to each backend URL (for example the WSGI app
+# under uwsgi and the ASGI app under uvicorn) from concurrent clients, and
+# prints the throughput and latency percentiles of each one:
+#
+#   python3 bench/load.py search http://localhost:8080 http://localhost:8000 \
+#       --query 'bbox=-5,41,10,52&when=last7days' --requests 2000 --concurrency 16
+#
+# Only the standard library is used, so that the clients don't need the
+# backend dependencies.
+
+import argparse
+import http.client
+import math
+import threading
+import time
+import urllib.parse
+
+
+def percentile(values, p):
+    # nearest rank percentile of sorted values
+    if not values:
+        return 0
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+class Load:
+    """Requests sent to a backend by concurrent clients, one connection per client."""
+
+    def __init__(self, url, concurrency):
+        self.url = urllib.parse.urlsplit(url)
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+
+    def connection(self):
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.netloc, timeout=60)
+        return http.client.HTTPConnection(self.url.netloc, timeout=60)
+
+    def request(self, conn, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        conn.request(method, self.url.path.rstrip('/') + path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(seconds)
+            self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+
+    def run(self, requests):
+        """Send requests, a list of (method, path, body), return the elapsed seconds."""
+        todo = iter(requests)
+
+        def client():
+            conn = self.connection()
+            try:
+                while True:
+                    with self.lock:
+                        r = next(todo, None)
+                    if r is None:
+                        return
+                    self.request(conn, *r)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=client) for i in range(self.concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+    def report(self, name, elapsed, items=None):
+        latencies = sorted(self.latencies)
+        line = '%-40s %6d requests %8.1f req/s' % (name, len(latencies), len(latencies) / elapsed)
+        if items is not None:
+            line += ' %8.1f events/s' % (items / elapsed)
+        line += '  p50 %6.1f ms  p95 %6.1f ms  p99 %6.1f ms  max %6.1f ms  status %s' % tuple(
+            [percentile(latencies, p) * 1000 for p in (50, 95, 99)] + [latencies[-1] * 1000 if latencies else 0]
+            + [','.join('%s:%d' % s for s in sorted(self.statuses.items()))])
+        print(line)
+
+
+def search(args):
+    path = '/event?' + args.query if args.query else '/event'
+    for url in args.urls:
+        # warm up connections, prepared statements and caches
+        Load(url, args.concurrency).run([('GET', path, None)] * args.concurrency)
+        load = Load(url, args.concurrency)
+        elapsed = load.run([('GET', path, None)] * args.requests)
+        load.report(url, elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='openeventdatabase load test')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('search', help='GET /event with the same query on each backend')
+    p.add_argument('urls', nargs='+', help='backend base URLs')
+    p.add_argument('--query', default='', help='search query string')
+    p.add_argument('--requests', type=int, default=1000)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.set_defaults(run=search)
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,169 @@
+# maintenance.py
+# openeventdatabase, partitions of the events and events_deleted tables,
+# simplified geometries of geo
+#
+# Monthly partitions are created ahead of time, and for the months of the
+# rows found in the default partition (events loaded before their month
+# had a partition). The ones older than the kept months are detached from
+# the tables searched by the API, and moved to the archive schema.
+# To be run daily, from cron:
+#
+#   python3 maintenance.py create [months ahead, default 3]
+#   python3 maintenance.py archive [months kept, default 12]
+#
+# The simplified geometries (geom_s1, geom_s2, geom_s3) of geo rows loaded
+# without them (restored database) are computed by:
+#
+#   python3 maintenance.py simplify [rows per batch, default 1000]
+
+import re
+import sys
+from datetime import date
+
+from backend import db_connect, SIMPLIFY_LEVELS
+
+# partitioned table, partition key
+TABLES = (('events', 'events_end'), ('events_deleted', 'deletedate'))
+# table of the unique ids of a partitioned table, kept by a trigger (setup.sql)
+IDS = dict(events='events_ids')
+
+
+def month(d, n=0):
+    """First day of the month n months after the one of d."""
+    m = d.year * 12 + d.month - 1 + n
+    return date(m // 12, m % 12 + 1, 1)
+
+
+def monthly(table, names):
+    """Return {first day of month: name} of the monthly partitions of table among names."""
+    found = {}
+    for name in names:
+        m = re.match(r'^(archive\.)?%s_([0-9]{4})_([0-9]{2})$' % table, name)
+        if m:
+            found[date(int(m.group(2)), int(m.group(3)), 1)] = name
+    return found
+
+
+def partitions(cur, table):
+    """Return {first day of month: name} of the monthly partitions of table."""
+    cur.execute("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON (c.oid = i.inhrelid)
+                    WHERE i.inhparent = %s::regclass""", (table,))
+    return monthly(table, [name for name, in cur.fetchall()])
+
+
+def archived(cur, table):
+    """Return {first day of month: archive.name} of the archived partitions of table."""
+    cur.execute("""SELECT 'archive.' || c.relname FROM pg_class c JOIN pg_namespace n ON (n.oid = c.relnamespace)
+                    WHERE n.nspname = 'archive' AND c.relkind = 'r'""")
+    return monthly(table, [name for name, in cur.fetchall()])
+
+
+def oldest(cur, table, key):
+    """Return the first day of the month of the oldest row of the default partition, None if empty."""
+    cur.execute("SELECT min({key}) FROM {table}_default WHERE isfinite({key});".format(table=table, key=key))
+    first = cur.fetchone()[0]
+    return None if first is None else month(first)
+
+
+def move(cur, table, key, name, start, stop):
+    """Move the rows of the default partition of table between start and stop to the table name."""
+    # writes to the default partition wait until the move is committed,
+    # ATTACH would fail on rows of the month inserted in between
+    cur.execute("LOCK TABLE %s_default IN SHARE ROW EXCLUSIVE MODE;" % table)
+    cur.execute("""WITH moved AS (DELETE FROM {table}_default WHERE {key} >= %s AND {key} < %s RETURNING *)
+                    INSERT INTO {name} SELECT * FROM moved;""".format(table=table, key=key, name=name),
+                (start.isoformat(), stop.isoformat()))
+    moved = cur.rowcount
+    if table in IDS and moved:
+        # the ids removed by the DELETE trigger, name has no trigger yet
+        cur.execute("INSERT INTO {ids} SELECT events_id FROM {name} ON CONFLICT DO NOTHING;".format(ids=IDS[table], name=name))
+    return moved
+
+
+def create(db, ahead):
+    """Create the monthly partitions of the next months, and of the months
+    of the rows left in the default partition (reloaded or past events).
+
+    Rows of months already archived are moved to their archived partition.
+    """
+    cur = db.cursor()
+    for table, key in TABLES:
+        existing = partitions(cur, table)
+        old = archived(cur, table)
+        start = oldest(cur, table, key)
+        if start is None or start > month(date.today()):
+            start = month(date.today())
+        while start <= month(date.today(), ahead):
+            stop = month(start, 1)
+            if start in old:
+                moved = move(cur, table, key, old[start], start, stop)
+                db.commit()
+                if moved:
+                    print('moved %d rows to %s' % (moved, old[start]))
+            elif start not in existing:
+                name = '%s_%s' % (table, start.strftime('%Y_%m'))
+                # rows of the month already in the default partition are moved to
+                # the new one, indexes, constraints and triggers are added by ATTACH
+                cur.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS);" % (name, table))
+                move(cur, table, key, name, start, stop)
+                cur.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s);" % (table, name),
+                            (start.isoformat(), stop.isoformat()))
+                db.commit()
+                print('created %s' % name)
+            start = stop
+    cur.close()
+
+
+def archive(db, keep):
+    cur = db.cursor()
+    cur.execute("CREATE SCHEMA IF NOT EXISTS archive;")
+    db.commit()
+    limit = month(date.today(), -keep)
+    for table, key in TABLES:
+        for start, name in sorted(partitions(cur, table).items()):
+            if month(start, 1) > limit:
+                continue
+            cur.execute("ALTER TABLE %s DETACH PARTITION %s;" % (table, name))
+            cur.execute("ALTER TABLE %s SET SCHEMA archive;" % name)
+            db.commit()
+            print('archived %s' % name)
+    cur.close()
+
+
+def simplify(db, batch):
+    """Compute the simplified geometries of geo rows which have none, batch rows per transaction."""
+    cur = db.cursor()
+    # geo_simplify is NULL when no point is removed, rows are read in hash
+    # order so that each one is only computed once
+    levels = ', '.join('%s = geo_simplify(geom, %s)' % (column, tolerance) for tolerance, column in SIMPLIFY_LEVELS)
+    empty = ' AND '.join('%s IS NULL' % column for tolerance, column in SIMPLIFY_LEVELS)
+    last = ''
+    total = 0
+    while True:
+        cur.execute("""UPDATE geo SET {levels} WHERE hash IN
+                            (SELECT hash FROM geo WHERE hash > %s AND {empty} AND ST_NPoints(geom) > 2
+                                ORDER BY hash LIMIT %s)
+                        RETURNING hash;""".format(levels=levels, empty=empty), (last, batch))
+        hashes = [h for h, in cur.fetchall()]
+        db.commit()
+        if not hashes:
+            break
+        last = max(hashes)
+        total += len(hashes)
+        print('simplified %d geometries' % total)
+    cur.close()
+
+
+if __name__ == '__main__':
+    commands = dict(create=(create, 3), archive=(archive, 12), simplify=(simplify, 1000))
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print('usage: %s create|archive [months] or simplify [rows]' % sys.argv[0])
+        sys.exit(1)
+    command, n = commands[sys.argv[1]]
+    if len(sys.argv) > 2:
+        n = int(sys.argv[2])
+    db = db_connect()
+    try:
+        command(db, n)
+    finally:
+        db.close()
@@ -1,35 +1,88 @@
-# This function is free of any dependencies.
-# source: https://github.com/mgd722/decode-google-maps-polyline
-def decode_polyline(polyline_str):
+# Encoded polylines (Google Maps algorithm), with any precision.
+# This module is free of any dependencies.
+# decoder originally from: https://github.com/mgd722/decode-google-maps-polyline
+from itertools import accumulate
+import math
+
+
+def decode_values(polyline_str):
+    '''Return the list of signed integers encoded in polyline_str'''
+    values = []
+    result, shift = 0, 0
+    for byte in polyline_str.encode('ascii'):
+        byte -= 63
+        if not 0 <= byte < 64:
+            raise ValueError('invalid polyline character: %r' % chr(byte + 63))
+        result |= (byte & 0x1f) << shift
+        if byte < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            result, shift = 0, 0
+        else:
+            shift += 5
+    if shift:
+        raise ValueError('truncated polyline')
+    return values
+
+
+def decode_polyline(polyline_str, precision=5):
     '''Pass a Google Maps encoded polyline string; returns list of lat/lon pairs'''
-    index, lat, lng = 0, 0, 0
-    coordinates = []
-    changes = {'latitude': 0, 'longitude': 0}
-
-    # Coordinates have variable length when encoded, so just keep
-    # track of whether we've hit the end of the string. In each
-    # while loop iteration, a single coordinate is decoded.
-    while index < len(polyline_str):
-        # Gather lat/lon changes, store them in a dictionary to apply them later
-        for unit in ['latitude', 'longitude']: 
-            shift, result = 0, 0
-
-            while True:
-                byte = ord(polyline_str[index]) - 63
-                index+=1
-                result |= (byte & 0x1f) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
-
-            if (result & 1):
-                changes[unit] = ~(result >> 1)
-            else:
-                changes[unit] = (result >> 1)
-
-        lat += changes['latitude']
-        lng += changes['longitude']
-
-        coordinates.append((lat / 100000.0, lng / 100000.0))
-
-    return coordinates
+    values = decode_values(polyline_str)
+    if len(values) % 2:
+        raise ValueError('truncated polyline')
+    factor = 10.0 ** precision
+    # coordinates are deltas from the previous point
+    return [(lat / factor, lng / factor)
+            for lat, lng in zip(accumulate(values[0::2]), accumulate(values[1::2]))]
+
+
+def decode_polylines(polylines, precision=5):
+    '''Decode many polylines; returns a list of lat/lon pairs lists'''
+    return [decode_polyline(p, precision) for p in polylines]
+
+
+def encode_polyline(coordinates, precision=5):
+    '''Pass a list of lat/lon pairs; returns a Google Maps encoded polyline string'''
+    factor = 10 ** precision
+    chunks = []
+    previous = (0, 0)
+    for point in coordinates:
+        # rounded half away from zero, like the reference implementation
+        point = tuple(int(math.copysign(math.floor(abs(c) * factor + 0.5), c)) for c in point[:2])
+        for value, last in zip(point, previous):
+            value = value - last
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previous = point
+    return ''.join(chunks)
+
+
+def simplify(coordinates, tolerance):
+    '''Douglas-Peucker simplification of a list of pairs; tolerance is in coordinate units'''
+    if len(coordinates) < 3:
+        return list(coordinates)
+    keep = [False] * len(coordinates)
+    keep[0] = keep[-1] = True
+    tolerance = tolerance * tolerance
+    ranges = [(0, len(coordinates) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        (ay, ax), (by, bx) = coordinates[first][:2], coordinates[last][:2]
+        dx, dy = bx - ax, by - ay
+        norm = dx * dx + dy * dy
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            py, px = coordinates[i][:2]
+            # squared distance to the [first, last] segment
+            t = ((px - ax) * dx + (py - ay) * dy) / norm if norm else 0
+            t = min(1, max(0, t))
+            d = (ax + t * dx - px) ** 2 + (ay + t * dy - py) ** 2
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            ranges.append((first, farthest))
+            ranges.append((farthest, last))
+    return [c for c, k in zip(coordinates, keep) if k]
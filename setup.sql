@@ -7,6 +7,7 @@
 
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 CREATE EXTENSION IF NOT EXISTS "postgis";
+CREATE EXTENSION IF NOT EXISTS "ltree";
 
 SET statement_timeout = 0;
 SET lock_timeout = 0;
@@ -34,8 +35,14 @@ CREATE TABLE events (
     events_what text,
     events_when tstzrange,
     events_geo text,
-    events_tags jsonb
-);
+    events_tags jsonb,
+    events_end timestamp with time zone NOT NULL
+) PARTITION BY RANGE (events_end);
+
+-- events_end is coalesce(upper(events_when), 'infinity'), set by the backend.
+-- Monthly partitions are created by maintenance.py, which also detaches old
+-- ones, other events go to the default partition.
+CREATE TABLE events_default PARTITION OF events DEFAULT;
 
 
 CREATE TABLE events_deleted (
@@ -46,8 +53,11 @@ CREATE TABLE events_deleted (
     events_what text,
     events_when tstzrange,
     events_geo text,
-    events_tags jsonb
-);
+    events_tags jsonb,
+    deletedate timestamp without time zone DEFAULT now()
+) PARTITION BY RANGE (deletedate);
+
+CREATE TABLE events_deleted_default PARTITION OF events_deleted DEFAULT;
 
 
 --
@@ -58,7 +68,10 @@ CREATE TABLE geo (
     geom geometry(Geometry,4326),
     hash text,
     geom_center geometry(Point,4326),
-    idx geometry
+    idx geometry,
+    geom_s1 geometry(Geometry,4326),
+    geom_s2 geometry(Geometry,4326),
+    geom_s3 geometry(Geometry,4326)
 );
 
 
@@ -74,14 +87,14 @@ ALTER TABLE ONLY geo
 -- Name: events_idx_antidup; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE UNIQUE INDEX events_idx_antidup ON events USING btree (events_geo, events_what, events_when);
+CREATE UNIQUE INDEX events_idx_antidup ON events USING btree (events_geo, events_what, events_when, events_end);
 
 
 --
 -- Name: events_idx_id; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE UNIQUE INDEX events_idx_id ON events USING btree (events_id);
+CREATE UNIQUE INDEX events_idx_id ON events USING btree (events_id, events_end);
 
 
 --
@@ -111,6 +124,9 @@ CREATE INDEX events_idx_when ON events USING spgist (events_when);
 
 CREATE INDEX geo_geom ON geo USING gist (geom);
 
+-- near, polyline and geometry searches (ST_DWithin on geography)
+CREATE INDEX geo_geog ON geo USING gist ((geom::geography));
+
 
 --
 -- Name: geo_idx; Type: INDEX; Schema: public; Owner: -
@@ -133,12 +149,44 @@ $$ LANGUAGE plpgsql;
 
 CREATE TRIGGER events_lastupdate_trigger BEFORE INSERT OR UPDATE ON events FOR EACH ROW EXECUTE PROCEDURE events_lastupdate();
 
+-- unique events_id across partitions (events_idx_id includes the partition key).
+-- Events moved to another partition by an UPDATE are deleted then inserted,
+-- ids of archived partitions stay reserved.
+CREATE TABLE events_ids (
+    events_id uuid PRIMARY KEY
+);
+
+CREATE FUNCTION events_ids() RETURNS trigger AS $$
+BEGIN
+	  IF TG_OP = 'DELETE' THEN
+	      DELETE FROM events_ids WHERE events_id = OLD.events_id;
+	  ELSE
+	      INSERT INTO events_ids VALUES (NEW.events_id);
+	  END IF;
+
+	  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER events_ids_trigger AFTER INSERT OR DELETE ON events FOR EACH ROW EXECUTE PROCEDURE events_ids();
+
+-- wakes up the clients waiting on /event/changes, once the changes are committed
+CREATE FUNCTION events_notify() RETURNS trigger AS $$
+BEGIN
+	  PERFORM pg_notify('events_changes', TG_OP);
+
+	  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER events_notify_trigger AFTER INSERT OR UPDATE OR DELETE ON events FOR EACH STATEMENT EXECUTE PROCEDURE events_notify();
+
 
 --
 -- Name: geo_pk; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY events
+ALTER TABLE events
     ADD CONSTRAINT geo_pk FOREIGN KEY (events_geo) REFERENCES geo(hash);
 
 
@@ -149,3 +197,56 @@ ALTER TABLE ONLY events
 
 CREATE INDEX events_idx_where_osm ON events USING spgist ((events_tags->>'where:osm')) WHERE events_tags ? 'where:osm';
 CREATE INDEX events_idx_where_wikidata ON events USING spgist ((events_tags->>'where:wikidata')) WHERE events_tags ? 'where:wikidata';
+-- simplified geometries stored in geo (geom_s1, geom_s2, geom_s3 at 0.0001, 0.001
+-- and 0.01 degree), NULL when simplification would not remove any point
+CREATE FUNCTION geo_simplify(geom geometry, tolerance float8) RETURNS geometry AS $$
+    SELECT CASE WHEN ST_NPoints(s) < ST_NPoints(geom) THEN s END
+        FROM (SELECT ST_SimplifyPreserveTopology(geom, tolerance) AS s) AS g;
+$$ LANGUAGE sql IMMUTABLE STRICT;
+-- 'what' as an ltree path, for the what= hierarchy filter (invalid label characters become _)
+CREATE FUNCTION what_path(what text) RETURNS ltree AS $$
+    SELECT text2ltree(trim(both '.' from regexp_replace(regexp_replace(what, '[^A-Za-z0-9_.]', '_', 'g'), '\.\.+', '.', 'g')));
+$$ LANGUAGE sql IMMUTABLE STRICT;
+CREATE INDEX events_idx_what_path ON events USING gist (what_path(events_what));
+-- tags= search filter (@> containment)
+CREATE INDEX events_idx_tags ON events USING gin (events_tags jsonb_path_ops);
+-- search results order, and keyset pagination (cursor)
+CREATE INDEX events_idx_createdate ON events USING btree (createdate DESC, events_id DESC);
+
+-- summary about last 10000 events, used by /stats and refreshed by the backend
+CREATE MATERIALIZED VIEW events_stats AS
+    SELECT events_what as what, left(max(upper(events_when))::text,19) as last, count(*) as count,
+           array_agg(distinct(regexp_replace(regexp_replace(events_tags ->> 'source','^(http://|https://)',''),'/.*',''))) as source,
+           now() as refreshed
+        FROM (SELECT * FROM events ORDER BY lastupdate DESC LIMIT 10000) as last
+        GROUP BY 1;
+-- needed by REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX events_stats_what ON events_stats (what);
+
+-- change feed (/event/changes)
+CREATE INDEX events_deleted_idx_deletedate ON events_deleted USING btree (deletedate, events_id);
+
+-- number of events per 'what', used by /event/what and refreshed by the backend
+CREATE MATERIALIZED VIEW events_what_stats AS
+    SELECT events_what as what, count(*) as count, count(*) FILTER (WHERE events_when @> now()) as active,
+           now() as refreshed
+        FROM events WHERE events_what IS NOT NULL
+        GROUP BY 1;
+CREATE UNIQUE INDEX events_what_stats_what ON events_what_stats (what);
+
+-- used by bulk loads (/event/bulk) to report invalid features one by one:
+-- NULL instead of an error aborting the whole batch
+CREATE FUNCTION bulk_geometry(geojson text) RETURNS geometry AS $$
+BEGIN
+    RETURN st_setsrid(st_geomfromgeojson(geojson), 4326);
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+CREATE FUNCTION bulk_when(event_start text, event_stop text, bounds text) RETURNS tstzrange AS $$
+BEGIN
+    RETURN tstzrange(event_start::timestamptz, event_stop::timestamptz, bounds);
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
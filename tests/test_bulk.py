@@ -0,0 +1,48 @@
+# data sent by EventBulk with COPY, no database needed
+import backend
+
+
+class CopyCursor:
+    def copy_expert(self, sql, data):
+        self.sql = sql
+        self.data = data.read()
+
+
+def copy(rows):
+    cur = CopyCursor()
+    backend.event_bulk.copy(cur, 'bulk_events', ('n', 'events_what', 'events_geo'), rows)
+    return cur
+
+
+def test_copy_null():
+    cur = copy([(0, None, None), (1, '', 'h')])
+    assert cur.sql == "COPY bulk_events (n, events_what, events_geo) FROM STDIN"
+    # NULL is \N, an empty string stays empty
+    assert cur.data == '0\t\\N\t\\N\n1\t\th\n'
+
+
+def test_copy_escape():
+    cur = copy([(0, 'a\tb\nc\rd', '{"k": "\\\\N"}')])
+    assert cur.data == '0\ta\\tb\\nc\\rd\t{"k": "\\\\\\\\N"}\n'
+
+
+
+def test_check_features():
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [1, 2]},
+         "properties": {"type": "scheduled", "what": "test", "when": "2024-01-01"}},
+        {"type": "Feature", "geometry": None, "properties": None},
+        {"type": "Feature", "geometry": None, "properties": "x"},
+        {"type": "Feature", "geometry": {"type": "Point"},
+         "properties": {"type": "scheduled", "what": "test", "when": "2024-01-01"}},
+        {"type": "Feature", "geometry": None,
+         "properties": {"type": "scheduled", "what": "a\u0000", "when": "2024-01-01"}},
+        {"type": "Feature", "geometry": None,
+         "properties": {"type": "scheduled", "what": "\\u0000", "when": "2024-01-01"}},
+        "x",
+    ]
+    body = '\n'.join(backend.dumps(f) for f in features) + '\n{'
+    results, events, geometries, cached = backend.event_bulk.check_features(body)
+    assert [r and list(r) for r in results] == [None, ['error'], ['error'], ['error'], ['error'], None, ['error'], ['error']]
+    assert [i for i, j, key in events] == [0, 5]
+    assert list(geometries) == [events[0][2]]
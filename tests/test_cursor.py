@@ -0,0 +1,26 @@
+# keyset pagination cursors, no database needed
+from datetime import datetime
+
+import falcon
+import pytest
+
+import backend
+
+
+def test_cursor_round_trip():
+    key = [12, datetime(2024, 1, 2, 3, 4, 5, 6), '00000000-0000-0000-0000-000000000001']
+    cursor = backend.event.encode_cursor(key)
+    assert '=' not in cursor
+    assert backend.event.decode_cursor(cursor) == (12, '2024-01-02T03:04:05.000006', key[2])
+
+
+@pytest.mark.parametrize('cursor', ['', 'x', backend.event.encode_cursor([1, 2])])
+def test_cursor_invalid(cursor):
+    with pytest.raises(falcon.HTTPBadRequest):
+        backend.event.decode_cursor(cursor)
+
+
+def test_next_cursor():
+    assert backend.event.next_cursor(10, [None, 'd', 'i'], 20) is None
+    assert backend.event.next_cursor(20, [None, 'd', 'i'], 20) is not None
+    assert backend.event.next_cursor(0, None, 0) is None
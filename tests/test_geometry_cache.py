@@ -0,0 +1,44 @@
+# geometry cache helpers, no database needed
+import pytest
+
+import backend
+
+
+def test_geometry_key_formatting():
+    a = {"type": "Point", "coordinates": [2, 48.5]}
+    b = {"coordinates": [2.0, 48.50], "type": "Point", "crs": None}
+    assert backend.geometry_key(a) == backend.geometry_key(b)
+    assert backend.geometry_key(a) != backend.geometry_key({"type": "Point", "coordinates": [48.5, 2]})
+
+
+def test_geometry_key_collection():
+    g = {"type": "GeometryCollection", "geometries": [{"type": "Point", "coordinates": [1, 2]}]}
+    assert backend.geometry_key(g) == backend.geometry_key(
+        {"type": "GeometryCollection", "geometries": [{"type": "Point", "coordinates": [1.0, 2.0]}]})
+
+
+@pytest.mark.parametrize('geometry', [None, {}, {"type": "Point"}, {"type": "Point", "coordinates": ["x"]}])
+def test_geometry_key_invalid(geometry):
+    assert backend.geometry_key(geometry) is None
+
+
+def test_lru_cache():
+    cache = backend.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # b is the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    cache.discard('a')
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (3, 2, 1, 1)
+
+
+def test_lru_cache_disabled():
+    cache = backend.LRUCache(0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert cache.stats()['hit_rate'] == 0
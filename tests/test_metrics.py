@@ -0,0 +1,41 @@
+# request metrics, no database needed
+import backend
+
+
+def test_metrics_render():
+    metrics = backend.Metrics(slow_query=1, explain_rate=0)
+    metrics.observe('/event', 'GET', 200, 0.03, {'query': 0.02})
+    metrics.slow_query_sample('SELECT  1', 2)
+    text = metrics.render({('oedb_test', 'gauge', 'Test "value"'): 5})
+    lines = text.splitlines()
+    assert 'oedb_request_seconds_bucket{method="GET",route="/event",status="200",le="0.025"} 0' in lines
+    assert 'oedb_request_seconds_bucket{method="GET",route="/event",status="200",le="0.05"} 1' in lines
+    assert 'oedb_request_seconds_bucket{method="GET",route="/event",status="200",le="+Inf"} 1' in lines
+    assert 'oedb_request_seconds_count{method="GET",route="/event",status="200"} 1' in lines
+    assert 'oedb_request_phase_seconds_total{phase="query",route="/event"} 0.020000' in lines
+    assert 'oedb_slow_queries_total 1' in lines
+    assert lines[-3:] == ['# HELP oedb_test Test "value"', '# TYPE oedb_test gauge', 'oedb_test 5']
+    assert text.endswith('\n')
+    assert metrics.slow[0]['sql'] == 'SELECT 1'
+
+
+def test_metrics_label_escaping():
+    metrics = backend.Metrics(slow_query=1, explain_rate=0)
+    metrics.observe('/a"b\\c', 'GET', 200, 0.01, {})
+    assert 'route="/a\\"b\\\\c"' in metrics.render({})
+
+
+def test_timed():
+    timings = {}
+    token = backend.request_timings.set(timings)
+    try:
+        with backend.timed('query'):
+            pass
+        with backend.timed('query'):
+            pass
+    finally:
+        backend.request_timings.reset(token)
+    assert list(timings) == ['query'] and timings['query'] >= 0
+    # outside of requests, nothing is recorded
+    with backend.timed('query'):
+        pass
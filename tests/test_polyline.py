@@ -0,0 +1,60 @@
+import pytest
+
+import polyline
+
+# example of the Google encoded polyline algorithm documentation
+POINTS = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+ENCODED = '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+
+
+def test_decode():
+    assert polyline.decode_polyline(ENCODED) == POINTS
+
+
+def test_encode():
+    assert polyline.encode_polyline(POINTS) == ENCODED
+
+
+def test_round_trip_precision():
+    points = [(48.8566141, 2.3522219), (-33.8688197, 151.2092955), (0, 0)]
+    encoded = polyline.encode_polyline(points, 7)
+    assert polyline.decode_polyline(encoded, 7) == points
+
+
+def test_rounding():
+    # half away from zero, like the reference implementation
+    encoded = polyline.encode_polyline([(0.000005, -0.000005)])
+    assert polyline.decode_polyline(encoded) == [(0.00001, -0.00001)]
+
+
+def test_empty():
+    assert polyline.encode_polyline([]) == ''
+    assert polyline.decode_polyline('') == []
+
+
+def test_decode_polylines():
+    assert polyline.decode_polylines([ENCODED, '']) == [POINTS, []]
+
+
+@pytest.mark.parametrize('encoded', ['_p~iF~ps|U_', '_p~iF', 'abc def'])
+def test_invalid(encoded):
+    with pytest.raises(ValueError):
+        polyline.decode_polyline(encoded)
+
+
+def test_simplify_straight_line():
+    line = [(0, 0), (1, 1), (2, 2), (3, 3)]
+    assert polyline.simplify(line, 0.1) == [(0, 0), (3, 3)]
+
+
+def test_simplify_keeps_far_points():
+    line = [(0, 0), (1, 0.55), (2, 1), (3, 0)]
+    assert polyline.simplify(line, 0.1) == [(0, 0), (2, 1), (3, 0)]
+    assert polyline.simplify(line, 0.01) == line
+
+
+def test_simplify_short_and_closed():
+    assert polyline.simplify([(0, 0), (1, 1)], 10) == [(0, 0), (1, 1)]
+    # first and last points are the same
+    ring = [(0, 0), (0, 1), (1, 1), (0, 0)]
+    assert polyline.simplify(ring, 0.5) == ring
@@ -0,0 +1,117 @@
+# ConnectionPool bookkeeping, with fake connections instead of a database
+import time
+import types
+
+import falcon
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import backend
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, sql):
+        if self.db.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.rollbacks = 0
+        self.info = types.SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        self.uses = 0
+        self.last_used = time.monotonic()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class Pool(backend.ConnectionPool):
+    def _connect(self):
+        self.counters['created'] += 1
+        return FakeConnection()
+
+
+def test_reuse():
+    pool = Pool(minconn=1, maxconn=2)
+    db = pool.getconn()
+    pool.putconn(db)
+    with pool.connection() as again:
+        assert again is db
+        assert pool.stats()['in_use'] == 1
+    stats = pool.stats()
+    assert (stats['created'], stats['borrowed'], stats['in_use'], stats['idle']) == (1, 2, 0, 1)
+
+
+def test_recycle():
+    pool = Pool(minconn=1, max_uses=2)
+    for i in range(2):
+        with pool.connection() as db:
+            pass
+    assert db.closed
+    assert pool.stats()['recycled'] == 1
+    with pool.connection() as other:
+        assert other is not db
+
+
+def test_exhausted():
+    pool = Pool(minconn=0, maxconn=1, timeout=0.01)
+    db = pool.getconn()
+    with pytest.raises(falcon.HTTPServiceUnavailable):
+        pool.getconn()
+    pool.putconn(db)
+    assert (pool.stats()['waits'], pool.stats()['timeouts']) == (1, 1)
+    # the slot is free again
+    pool.putconn(pool.getconn())
+
+
+def test_rollback_on_return():
+    pool = Pool(minconn=1)
+    with pool.connection() as db:
+        db.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    assert db.rollbacks == 1
+    assert not db.closed
+
+
+def test_broken_connections_discarded():
+    pool = Pool(minconn=1, check_idle=30)
+    with pool.connection() as closed:
+        pass
+    closed.closed = 1
+    with pool.connection() as db:
+        assert db is not closed
+    # idle for too long and not answering
+    db.broken = True
+    db.last_used = time.monotonic() - 60
+    with pool.connection() as other:
+        assert other is not db
+    assert db.closed
+    assert pool.stats()['broken'] == 2
+
+
+def test_fork():
+    pool = Pool(minconn=1)
+    with pool.connection() as parent:
+        pass
+    # as seen from a forked worker
+    pool.pid = -1
+    with pool.connection() as db:
+        assert db is not parent
+    assert pool.inherited == [parent]
+    assert not parent.closed
@@ -0,0 +1,54 @@
+# prepared statements built from named placeholders, no database needed
+import types
+
+import backend
+
+
+class FakeCursor:
+    def __init__(self, prepared=None):
+        self.connection = types.SimpleNamespace()
+        if prepared is not None:
+            self.connection.prepared = prepared
+        self.executed = []
+
+    def execute(self, sql, args=None):
+        self.executed.append((sql, args))
+
+
+def test_placeholders():
+    name, prepare, names = backend.prepare_statement(
+        "SELECT %(b)s::text, %(a)s::integer WHERE x LIKE 'a%%' AND y = %(b)s::text")
+    assert name.startswith('oedb_')
+    assert prepare == "PREPARE %s AS SELECT $1::text, $2::integer WHERE x LIKE 'a%%' AND y = $1::text" % name
+    assert names == ['b', 'a']
+
+
+def test_same_statement():
+    sql = "SELECT %(p0)s::integer"
+    assert backend.prepare_statement(sql) is backend.prepare_statement(sql)
+    assert backend.prepare_statement(sql)[0] != backend.prepare_statement(sql + ' ')[0]
+
+
+def test_execute_prepared_once():
+    cur = FakeCursor(prepared=set())
+    sql = "SELECT %(p0)s::integer, %(p1)s::text"
+    name, prepare, names = backend.prepare_statement(sql)
+    backend.execute_prepared(cur, sql, dict(p0=1, p1='a'))
+    backend.execute_prepared(cur, sql, dict(p0=2, p1='b'))
+    execute = 'EXECUTE %s (%%(p0)s,%%(p1)s)' % name
+    assert cur.executed == [(prepare, None), (execute, dict(p0=1, p1='a')), (execute, dict(p0=2, p1='b'))]
+    assert cur.connection.prepared == {name}
+
+
+def test_execute_prepared_without_parameters():
+    cur = FakeCursor(prepared=set())
+    name, prepare, names = backend.prepare_statement("SELECT 1")
+    backend.execute_prepared(cur, "SELECT 1", {})
+    assert cur.executed == [(prepare, None), ('EXECUTE %s' % name, None)]
+
+
+def test_execute_not_pooled():
+    # dedicated connections execute the statement itself
+    cur = FakeCursor()
+    backend.execute_prepared(cur, "SELECT %(p0)s::integer", dict(p0=1))
+    assert cur.executed == [("SELECT %(p0)s::integer", dict(p0=1))]
@@ -0,0 +1,61 @@
+# search statements built from query strings, no database needed
+import json
+
+import falcon.testing
+
+import backend
+
+
+def search(query_string):
+    req = falcon.testing.create_req(query_string=query_string)
+    return backend.event.search_query(req)
+
+
+def test_fields_comma_separated():
+    sql, params, geom_only = search('fields=label,start,stop')
+    assert params['fields'] == ['label', 'start', 'stop']
+
+
+def test_fields_repeated():
+    sql, params, geom_only = search('fields=label&fields=start,')
+    assert params['fields'] == ['label', 'start']
+
+
+def test_fields_projection():
+    req = falcon.testing.create_req(query_string='fields=label,start')
+    fields = backend.event.output_fields(req)
+    row = dict(events_id='1', events_tags=dict(label='a', start='b', stop='c', secret='s'),
+               createdate=None, lastupdate=None, lon=1, lat=2, geometry='null')
+    feature = backend.event.row_to_feature(row, fields=fields)
+    assert feature['properties'] == dict(id='1', label='a', start='b')
+
+
+def test_tags_comma_separated():
+    sql, params, geom_only = search('tags=k=v,k2')
+    assert ['{"k": "v"}'] in params.values()
+    assert ['k2'] in params.values()
+
+
+def test_tags_alternatives():
+    sql, params, geom_only = search('tags=a=1|2,b=3|4,c=5')
+    contains = [json.loads(c) for c in list(params.values())[0]]
+    assert contains == [dict(a='1', b='3', c='5'), dict(a='1', b='4', c='5'),
+                        dict(a='2', b='3', c='5'), dict(a='2', b='4', c='5')]
+
+
+def test_tags_statement_shape():
+    # the number of tags does not change the statement text (prepared statements)
+    assert search('tags=a=1,b,c=2|3')[0] == search('tags=d=4|5|6,e,f')[0]
+
+
+def test_bbox_not_split():
+    # comma separated parameters without a list of values are split by the backend
+    sql, params, geom_only = search('bbox=1,2,3,4')
+    assert ['1', '2', '3', '4'] == list(params.values())[:4]
+
+
+def test_what_comma_separated():
+    sql, params, geom_only = search('what=traffic,-traffic.jam,weather')
+    assert ['traffic', 'weather'] in params.values()
+    assert ['traffic.jam'] in params.values()
+    assert 'NOT what_path(events_what)' in sql
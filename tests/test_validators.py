@@ -0,0 +1,17 @@
+# ETag and Last-Modified of reads, no database needed
+from datetime import datetime, timezone
+
+import falcon.testing
+
+import backend
+
+
+def test_validators():
+    req = falcon.testing.create_req(query_string='what=a')
+    lastupdate = datetime(2024, 1, 2, 3, 4, 5, 600)
+    etag, last_modified = backend.event.validators(req, [('id', lastupdate)])
+    assert last_modified is None
+    other = falcon.testing.create_req(query_string='what=b')
+    assert backend.event.validators(other, [('id', lastupdate)])[0] != etag
+    etag, last_modified = backend.event.validators(req, [('id', lastupdate)], id='id', tz=timezone.utc)
+    assert last_modified == datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)